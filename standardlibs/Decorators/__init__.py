@@ -1,62 +1,873 @@
 '''
 This module provides function decorator methods.
 '''
+from collections import OrderedDict, deque, namedtuple
+import asyncio
 import functools
+import inspect
+import io
+import logging
 import math
+import operator
+import os
+import pickle
+import random
+import re
+import sqlite3
+import sys
+import threading
 import time
 import warnings
 import cProfile
 
 
-def memoize_expire(obj):
+_ROOT_LOGGER = logging.getLogger('rootLogger')
+
+_MISSING = object()  # sentinel for cache misses, None is a valid result
+
+# single arguments of these types are their own cache key
+_FAST_TYPES = frozenset((int, str))
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize',
+                                     'evictions', 'expirations',
+                                     'latency_saved'])
+
+
+class _CacheStats(object):
+
+    '''
+    Counters kept by a memoized function.  They are updated without locking,
+    so concurrent callers may occasionally lose a count.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0  # seconds of calls answered from the cache
+
+    def reset(self):
+        ''' Sets every counter back to zero. '''
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+
+
+class _Flight(object):
+
+    '''
+    A call to a memoized function which is still running.  Other threads
+    asking for the same key wait on it instead of repeating the call.
+    '''
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        '''
+        Blocks until the call finishes, then returns its result or raises its
+        exception.
+        '''
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _KwdMark(object):
+
+    '''
+    Separates positional from keyword arguments inside a cache key.  This is a
+    class rather than an instance so that keys stay picklable.
+    '''
+
+
+class _Sorted(tuple):
+
+    '''
+    The members of a set or the items of a dict, after the name of its type,
+    in a canonical order.  Stands in for them when a DiskCache pickles a key.
+    '''
+
+    __slots__ = ()
+
+
+def make_key(args, kwargs, typed=False):
+    '''
+    Builds a cache key from a call's arguments.  The key is a flat tuple of
+    the arguments themselves, so it is compared by equality rather than by
+    repr and costs no more than hashing the arguments.  A call with a single
+    int or str argument uses that argument as the key directly.
+
+    Keyword arguments are part of the key in the order they were passed, so
+    f(a=1, b=2) and f(b=2, a=1) are cached separately.
+
+    @param args: tuple of positional arguments
+    @param kwargs: dict of keyword arguments
+    @param typed: if True, arguments which compare equal but have different
+        types (1 and 1.0) get different keys
+    @return: a key which is hashable as long as every argument is
+    '''
+    key = args
+    if kwargs:
+        key += (_KwdMark,)
+        for item in kwargs.items():
+            key += item
+    if typed:
+        key += tuple(type(value) for value in args)
+        if kwargs:
+            key += tuple(type(value) for value in kwargs.values())
+    elif len(key) == 1 and type(key[0]) in _FAST_TYPES:
+        return key[0]
+    return key
+
+
+def _freeze(value):
+    '''
+    Converts lists, dicts and sets inside value to hashable equivalents.  The
+    converted containers are tagged with their type so that [1] and (1,) do
+    not end up as the same key.
+
+    @raise TypeError: if value holds something else which is unhashable
+    '''
+    if isinstance(value, (list, tuple)):
+        frozen = tuple(_freeze(item) for item in value)
+        return frozen if type(value) is tuple else (type(value), frozen)
+    if isinstance(value, dict):
+        return (type(value), frozenset(
+            (key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(value))
+    hash(value)
+    return value
+
+
+def _canonical(value):
+    '''
+    Returns value with the members of any sets and the items of any dicts in
+    it sorted by their pickles.  Sets iterate in an order which depends on
+    the hash seed of the process, so equal keys only pickle to the same
+    bytes in every process once their sets are sorted.
+    '''
+    kind = type(value)
+    if kind is tuple or kind is list:
+        return kind(_canonical(item) for item in value)
+    if kind is set or kind is frozenset:
+        items = [_canonical(item) for item in value]
+    elif kind is dict:
+        items = [(_canonical(key), _canonical(item))
+                 for key, item in value.items()]
+    else:
+        return value
+    items.sort(key=_dumps_fast)
+    return _Sorted((kind.__name__,) + tuple(items))
+
+
+def _dumps_fast(value):
+    '''
+    Pickles value without the memo, so equal values give equal bytes no
+    matter which of their parts are the same object.
+    '''
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, protocol=4)
+    pickler.fast = True
+    pickler.dump(value)
+    return buf.getvalue()
+
+
+class LRUCache(object):
+
+    '''
+    A bounded cache which evicts the least recently used entries once it holds
+    more than maxsize entries or more than maxbytes bytes of values.  Every
+    entry expires ttl seconds after it was stored.
+
+    Expired entries are dropped as part of each store instead of waiting to be
+    overwritten, so a cache which is no longer read from does not keep stale
+    results around.  Every operation holds an internal lock only while the
+    entries are updated, so one cache can be shared between threads.
+    '''
+
+    def __init__(self, *, maxsize=None, maxbytes=None, ttl=None,
+                 sizeof=sys.getsizeof):
+        '''
+        @param maxsize: maximum number of entries to hold, None is unbounded
+        @param maxbytes: maximum total size of the cached values in bytes as
+            measured by sizeof, None is unbounded
+        @param ttl: seconds each entry stays valid, None or 0 never expires
+        @param sizeof: callable which measures a value for maxbytes, the
+            default sys.getsizeof is shallow so pass a deeper measure when
+            caching containers
+        '''
+        if maxsize is not None and maxsize < 1:
+            raise ValueError("maxsize must be 1 or greater")
+        if maxbytes is not None and maxbytes < 1:
+            raise ValueError("maxbytes must be 1 or greater")
+        if ttl is not None and ttl < 0:
+            raise ValueError("ttl must be 0 or greater")
+
+        self.__maxsize = maxsize
+        self.__maxbytes = maxbytes
+        self.__ttl = ttl
+        self.__sizeof = sizeof
+
+        # key -> (value, expires, size, cost), least to most recently used
+        self.__data = OrderedDict()
+        # (expires, key) in the order entries were stored, every entry shares
+        # one ttl so this is also the order they expire in
+        self.__expiry = deque()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__evictions = 0
+        self.__expirations = 0
+
+    def get(self, key, default=None):
+        '''
+        Returns the value cached for key, or default if there is no entry or
+        the entry has expired.  A hit marks the entry as most recently used.
+        '''
+        return self.lookup(key, default)[0]
+
+    def lookup(self, key, default=None):
+        '''
+        Like get, but returns a (value, cost) tuple where cost is the number
+        given when the value was stored, or (default, 0.0) on a miss.
+        '''
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is None:
+                return default, 0.0
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self.__discard(key)
+                self.__expirations += 1
+                return default, 0.0
+            self.__data.move_to_end(key)
+            return entry[0], entry[3]
+
+    def set(self, key, value, cost=0.0):
+        '''
+        Stores value under key, then drops expired entries and evicts least
+        recently used entries until the cache is within its limits.  A value
+        larger than maxbytes on its own is not cached at all.
+
+        @param cost: seconds it took to produce value, returned by lookup so
+            callers can tell how much time a hit saved
+        '''
+        size = self.__sizeof(value) if self.__maxbytes is not None else 0
+        with self.__lock:
+            now = time.monotonic()
+            self.__discard(key)
+            if self.__maxbytes is not None and size > self.__maxbytes:
+                return
+
+            expires = now + self.__ttl if self.__ttl else None
+            self.__data[key] = (value, expires, size, cost)
+            self.__bytes += size
+            if expires is not None:
+                self.__expiry.append((expires, key))
+                self.__sweep(now)
+            self.__evict()
+
+    def pop(self, key, default=None):
+        '''
+        Removes the entry for key and returns its value, or default if there
+        is no live entry.
+        '''
+        with self.__lock:
+            entry = self.__data.get(key)
+            self.__discard(key)
+        if entry is None or (entry[1] is not None and
+                             entry[1] <= time.monotonic()):
+            return default
+        return entry[0]
+
+    def clear(self):
+        ''' Removes every entry and resets the eviction counters. '''
+        with self.__lock:
+            self.__data.clear()
+            self.__expiry.clear()
+            self.__bytes = 0
+            self.__evictions = 0
+            self.__expirations = 0
+
+    def sweep(self):
+        ''' Drops every expired entry now. '''
+        with self.__lock:
+            self.__sweep(time.monotonic())
+
+    def __sweep(self, now):
+        '''
+        Drops entries from the front of the expiry queue until the oldest one
+        left is still valid.  Records for keys which were stored again or
+        evicted since are stale and just skipped.
+        '''
+        expiry = self.__expiry
+        while expiry and expiry[0][0] <= now:
+            expires, key = expiry.popleft()
+            entry = self.__data.get(key)
+            if entry is not None and entry[1] == expires:
+                self.__discard(key)
+                self.__expirations += 1
+
+        # stale records only go away once they reach the front, so rebuild the
+        # queue if they ever outnumber the live entries
+        if len(expiry) > 2 * len(self.__data) + 64:
+            self.__expiry = deque(sorted(
+                ((entry[1], key) for key, entry in self.__data.items()),
+                key=operator.itemgetter(0)))
+
+    def __evict(self):
+        ''' Evicts least recently used entries until within the limits. '''
+        data = self.__data
+        while ((self.__maxsize is not None and len(data) > self.__maxsize) or
+               (self.__maxbytes is not None and
+                self.__bytes > self.__maxbytes)):
+            _, entry = data.popitem(last=False)
+            self.__bytes -= entry[2]
+            self.__evictions += 1
+
+    def __discard(self, key):
+        ''' Removes key without touching the expiry queue. '''
+        entry = self.__data.pop(key, None)
+        if entry is not None:
+            self.__bytes -= entry[2]
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get_maxsize(self):
+        ''' Returns the maximum number of entries, None if unbounded. '''
+        return self.__maxsize
+
+    def get_maxbytes(self):
+        ''' Returns the maximum total size in bytes, None if unbounded. '''
+        return self.__maxbytes
+
+    def get_ttl(self):
+        ''' Returns the seconds each entry stays valid. '''
+        return self.__ttl
+
+    def get_currbytes(self):
+        ''' Returns the total size of the cached values in bytes. '''
+        return self.__bytes
+
+    def get_evictions(self):
+        ''' Returns how many entries were evicted to stay within limits. '''
+        return self.__evictions
+
+    def get_expirations(self):
+        ''' Returns how many expired entries were dropped. '''
+        return self.__expirations
+
+    maxsize = property(get_maxsize, None, None, None)
+    maxbytes = property(get_maxbytes, None, None, None)
+    ttl = property(get_ttl, None, None, None)
+    currbytes = property(get_currbytes, None, None, None)
+    evictions = property(get_evictions, None, None, None)
+    expirations = property(get_expirations, None, None, None)
+
+
+class DiskCache(object):
+
+    '''
+    A cache stored in a sqlite database so that it survives restarts and can
+    be shared by several processes on the same host.  It has the same
+    interface and ttl semantics as LRUCache.
+
+    Keys and values are pickled, keys with the members of their sets and
+    dicts sorted so that they match across processes.  maxsize and maxbytes
+    (measured as the size of the pickled values) are enforced by least
+    recently used eviction every sweep_every stores, so the limits can be
+    exceeded briefly in between.
+    '''
+
+    def __init__(self, path, *, maxsize=None, maxbytes=None, ttl=None,
+                 sweep_every=32, timeout=30):
+        '''
+        Opens or creates the database at path, creating its directory.
+
+        @param path: the sqlite database file
+        @param maxsize: maximum number of entries to hold, None is unbounded
+        @param maxbytes: maximum total size of the pickled values in bytes,
+            None is unbounded
+        @param ttl: seconds each entry stays valid, None or 0 never expires
+        @param sweep_every: how many stores happen between removals of
+            expired and surplus entries
+        @param timeout: seconds to wait for another process holding the
+            database lock
+        '''
+        if maxsize is not None and maxsize < 1:
+            raise ValueError("maxsize must be 1 or greater")
+        if maxbytes is not None and maxbytes < 1:
+            raise ValueError("maxbytes must be 1 or greater")
+        if ttl is not None and ttl < 0:
+            raise ValueError("ttl must be 0 or greater")
+        if sweep_every < 1:
+            raise ValueError("sweep_every must be 1 or greater")
+
+        self.__path = path
+        self.__maxsize = maxsize
+        self.__maxbytes = maxbytes
+        self.__ttl = ttl
+        self.__sweep_every = sweep_every
+        self.__timeout = timeout
+        self.__stores = 0
+        # counted per process, the entries themselves are shared
+        self.__evictions = 0
+        self.__expirations = 0
+        # sqlite connections must not cross threads or forked processes
+        self.__local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self.__connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, '
+            'value BLOB NOT NULL, expires REAL, size INTEGER NOT NULL, '
+            'cost REAL NOT NULL, accessed REAL NOT NULL)')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+
+    def __connect(self):
+        ''' Returns the connection for the current thread and process. '''
+        local = self.__local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(self.__path, timeout=self.__timeout,
+                                         isolation_level=None)
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+
+    @staticmethod
+    def __dumps_key(key):
+        '''
+        Pickles a key so that equal keys give equal bytes, in any process:
+        without the memo, and with its sets and dicts in a canonical order.
+        '''
+        return _dumps_fast(_canonical(key))
+
+    def get(self, key, default=None):
+        '''
+        Returns the value cached for key, or default if there is no entry or
+        the entry has expired.  A hit marks the entry as most recently used
+        when the cache is bounded.
+        '''
+        return self.lookup(key, default)[0]
+
+    def lookup(self, key, default=None):
+        '''
+        Like get, but returns a (value, cost) tuple where cost is the number
+        given when the value was stored, or (default, 0.0) on a miss.
+        '''
+        blob = self.__dumps_key(key)
+        conn = self.__connect()
+        row = conn.execute(
+            'SELECT value, expires, cost FROM cache WHERE key = ?',
+            (blob,)).fetchone()
+        now = time.time()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return default, 0.0
+        if self.__maxsize is not None or self.__maxbytes is not None:
+            conn.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                         (now, blob))
+        return pickle.loads(row[0]), row[2]
+
+    def set(self, key, value, cost=0.0):
+        '''
+        Stores value under key.  Every sweep_every stores this also drops
+        expired entries and evicts least recently used entries until the cache
+        is within its limits.  A value larger than maxbytes on its own is not
+        cached at all.
+
+        @param cost: seconds it took to produce value, returned by lookup so
+            callers can tell how much time a hit saved
+        '''
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.__maxbytes is not None and len(blob) > self.__maxbytes:
+            self.pop(key)
+            return
+
+        now = time.time()
+        expires = now + self.__ttl if self.__ttl else None
+        self.__connect().execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+            (self.__dumps_key(key), blob, expires, len(blob), cost, now))
+
+        self.__stores += 1
+        if self.__stores % self.__sweep_every == 0:
+            self.sweep()
+
+    def pop(self, key, default=None):
+        '''
+        Removes the entry for key and returns its value, or default if there
+        is no live entry.
+        '''
+        blob = self.__dumps_key(key)
+        conn = self.__connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT value, expires FROM cache WHERE key = ?',
+                (blob,)).fetchone()
+            conn.execute('DELETE FROM cache WHERE key = ?', (blob,))
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return pickle.loads(row[0])
+
+    def clear(self):
+        ''' Removes every entry and resets the eviction counters. '''
+        self.__connect().execute('DELETE FROM cache')
+        self.__evictions = 0
+        self.__expirations = 0
+
+    def sweep(self):
+        '''
+        Drops every expired entry now, then evicts least recently used entries
+        until the cache is within its limits.
+        '''
+        conn = self.__connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self.__expirations += conn.execute(
+                'DELETE FROM cache WHERE expires <= ?',
+                (time.time(),)).rowcount
+            if self.__maxsize is not None:
+                self.__evictions += conn.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                    'ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.__maxsize,)).rowcount
+            if self.__maxbytes is not None:
+                self.__evictions += conn.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM '
+                    '(SELECT key, SUM(size) OVER (ORDER BY accessed DESC '
+                    'ROWS UNBOUNDED PRECEDING) AS total FROM cache) '
+                    'WHERE total > ?)', (self.__maxbytes,)).rowcount
+
+    def __len__(self):
+        return self.__connect().execute(
+            'SELECT COUNT(*) FROM cache WHERE expires IS NULL OR expires > ?',
+            (time.time(),)).fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get_path(self):
+        ''' Returns the path of the sqlite database. '''
+        return self.__path
+
+    def get_maxsize(self):
+        ''' Returns the maximum number of entries, None if unbounded. '''
+        return self.__maxsize
+
+    def get_maxbytes(self):
+        ''' Returns the maximum total size in bytes, None if unbounded. '''
+        return self.__maxbytes
+
+    def get_ttl(self):
+        ''' Returns the seconds each entry stays valid. '''
+        return self.__ttl
+
+    def get_currbytes(self):
+        ''' Returns the total size of the pickled values in bytes. '''
+        return self.__connect().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def get_evictions(self):
+        '''
+        Returns how many entries this process evicted to stay within limits.
+        '''
+        return self.__evictions
+
+    def get_expirations(self):
+        ''' Returns how many expired entries this process dropped. '''
+        return self.__expirations
+
+    path = property(get_path, None, None, None)
+    maxsize = property(get_maxsize, None, None, None)
+    maxbytes = property(get_maxbytes, None, None, None)
+    ttl = property(get_ttl, None, None, None)
+    currbytes = property(get_currbytes, None, None, None)
+    evictions = property(get_evictions, None, None, None)
+    expirations = property(get_expirations, None, None, None)
+
+
+def memoize_expire(obj=None, *, ttl=7200, maxsize=None, maxbytes=None,
+                   sizeof=sys.getsizeof, key=None, typed=False,
+                   thread_safe=False, cache_dir=None):
     '''
     Memoizes a function.  This will add results to a cache to be used later.
     This makes it possible to avoid calculating the same result twice and can
     help speed up operations.  This function will utilize a function's *args
-    and **kwargs.  This decorator has a built in two hour expiration time.
+    and **kwargs.  By default results expire after two hours.
 
     Each item cached will have its OWN expiration time.
+
+    Can be used bare (@memoize_expire) or with settings, for example
+    @memoize_expire(ttl=60, maxsize=1024).  The cache is an LRUCache which is
+    available as the cache attribute of the decorated function.
+
+    With cache_dir set the results are kept in a DiskCache in that directory
+    instead, so they survive restarts and are shared by every process using
+    the same directory.  Arguments and results must then be picklable.
+
+    Coroutine functions are supported: the awaited result is cached, and
+    concurrent awaiters of the same key on one event loop share a single
+    task.  Cancelling one awaiter does not cancel the shared task.
+
+    The decorated function gets cache_info(), which returns a CacheInfo of
+    hits, misses, maxsize, currsize, evictions, expirations and latency_saved
+    (the seconds the cached calls originally took, summed over every hit),
+    cache_clear(), which empties the cache and resets the statistics, and
+    cache_invalidate(*args, **kwargs), which drops the result for one call.
+
+    @param ttl: seconds each result stays cached, None or 0 never expires
+    @param maxsize: maximum number of results to cache, least recently used
+        results are evicted first, None is unbounded
+    @param maxbytes: maximum total size in bytes of the cached results as
+        measured by sizeof, None is unbounded
+    @param sizeof: callable used to measure results for maxbytes
+    @param key: callable taking the same arguments as the decorated function
+        and returning a hashable cache key, by default make_key is used and
+        lists, dicts and sets inside the arguments are converted as needed
+    @param typed: if True, arguments which compare equal but have different
+        types are cached separately (ignored when key is given)
+    @param thread_safe: if True, concurrent calls which miss on the same key
+        share a single call of the function instead of each making their own.
+        Only the bookkeeping of calls in progress is serialized, calls with
+        different keys run in parallel.
+    @param cache_dir: directory for a persistent DiskCache, None keeps the
+        results in memory only
+    '''
+    if obj is None:
+        return functools.partial(memoize_expire, ttl=ttl, maxsize=maxsize,
+                                 maxbytes=maxbytes, sizeof=sizeof, key=key,
+                                 typed=typed, thread_safe=thread_safe,
+                                 cache_dir=cache_dir)
+
+    if cache_dir is None:
+        cache = LRUCache(maxsize=maxsize, maxbytes=maxbytes, ttl=ttl,
+                         sizeof=sizeof)
+    else:
+        # one database per function, named after where it is defined
+        name = re.sub(r'[^\w.-]', '_', '{}.{}'.format(
+            obj.__module__, obj.__qualname__))
+        cache = DiskCache(os.path.join(cache_dir, name + '.sqlite'),
+                          maxsize=maxsize, maxbytes=maxbytes, ttl=ttl)
+    obj.cache = cache
+    stats = _CacheStats()
+    key_func = key
+
+    def build_key(args, kwargs):
+        '''
+        Returns the cache key for a call, converted to a hashable copy if an
+        argument is unhashable.  Checked here rather than left to the cache,
+        as a DiskCache pickles any key and the key is also looked up in the
+        dicts of calls in flight.
+        '''
+        if key_func is None:
+            key = make_key(args, kwargs, typed)
+        else:
+            key = key_func(*args, **kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            key = _freeze(key)
+        return key
+
+    def lookup(args, kwargs):
+        '''
+        Returns the cache key for a call and its cached result, or _MISSING,
+        and counts the hit or miss.
+        '''
+        key = build_key(args, kwargs)
+        result, cost = cache.lookup(key, _MISSING)
+        if result is _MISSING:
+            stats.misses += 1
+        else:
+            stats.hits += 1
+            stats.saved += cost
+        return key, result
+
+    if inspect.iscoroutinefunction(obj):
+        memoizer = _memoize_async(obj, cache, lookup)
+    else:
+        memoizer = _memoize_sync(obj, cache, lookup, thread_safe)
+
+    def cache_info():
+        ''' Returns a CacheInfo with the statistics of this cache. '''
+        return CacheInfo(stats.hits, stats.misses, cache.maxsize, len(cache),
+                         cache.evictions, cache.expirations, stats.saved)
+
+    def cache_clear():
+        ''' Removes every cached result and resets the statistics. '''
+        cache.clear()
+        stats.reset()
+
+    def cache_invalidate(*args, **kwargs):
+        '''
+        Removes the cached result for a call with these arguments.
+
+        @return: True if there was a cached result to remove
+        '''
+        key = build_key(args, kwargs)
+        return cache.pop(key, _MISSING) is not _MISSING
+
+    memoizer.cache_info = cache_info
+    memoizer.cache_clear = cache_clear
+    memoizer.cache_invalidate = cache_invalidate
+    return memoizer
+
+
+def _memoize_sync(obj, cache, lookup, thread_safe):
+    '''
+    Builds the memoize_expire wrapper for a regular function.  With
+    thread_safe, misses register a _Flight which callers for the same key
+    wait on until the first call finishes.
     '''
-    cache = obj.cache = {}
-    expire_time = 7200  # expire every two hours (2*60*60)
+    flights = {}  # key -> _Flight for calls in progress (thread_safe only)
+    flights_lock = threading.Lock()
+
+    def call(key, args, kwargs):
+        ''' Calls the function and caches the result with its cost. '''
+        start = time.perf_counter()
+        result = obj(*args, **kwargs)
+        cache.set(key, result, time.perf_counter() - start)
+        return result
 
     @functools.wraps(obj)
     def memoizer(*args, **kwargs):
         '''
         The actual function which manages the cache.
         '''
-#         key = str(args) + str(kwargs)
-        key = str(args) + str(hash(frozenset(kwargs.items())))
+        key, result = lookup(args, kwargs)
+        if result is not _MISSING:
+            return result
 
-        if key in cache:
-            result, timestamp = cache[key]
-            # check the age
-            age = time.time() - timestamp
-            if not expire_time or age < expire_time:
+        if not thread_safe:
+            # else cache it (the cache tracks its age) and return the result
+            return call(key, args, kwargs)
+
+        with flights_lock:
+            # the call may have finished since the lookup above
+            result = cache.lookup(key, _MISSING)[0]
+            if result is not _MISSING:
                 return result
-            # if it IS expired, the code below is executed to re-cache results
+            flight = flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = flights[key] = _Flight()
 
-        # else cache it with timestamp and then return just the result
-        result = obj(*args, **kwargs)
-        cache[key] = (result, time.time())
-        return result
+        if not leader:
+            if flight.owner == threading.get_ident():
+                # a recursive call for the key this thread is computing
+                return obj(*args, **kwargs)
+            return flight.wait()
+
+        try:
+            flight.result = call(key, args, kwargs)
+            return flight.result
+        except BaseException as ex:
+            flight.error = ex
+            raise
+        finally:
+            with flights_lock:
+                del flights[key]
+            flight.done.set()
 
     return memoizer
 
 
-def retry(tries, delay=3, backoff=2):
+def _memoize_async(obj, cache, lookup):
     '''
-    Retries a function or method until it returns True.
+    Builds the memoize_expire wrapper for a coroutine function.  Misses start
+    a task which stores its result in the cache when it finishes, and further
+    calls for the same key await that task until then.
+    '''
+    tasks = {}  # key -> asyncio.Task for calls in progress
+
+    def finish(key, start, task):
+        ''' Caches the result of a finished task with its cost. '''
+        if tasks.get(key) is task:
+            del tasks[key]
+        if not task.cancelled() and task.exception() is None:
+            cache.set(key, task.result(), time.perf_counter() - start)
+
+    @functools.wraps(obj)
+    async def memoizer(*args, **kwargs):
+        '''
+        The actual coroutine which manages the cache.
+        '''
+        key, result = lookup(args, kwargs)
+        if result is not _MISSING:
+            return result
+
+        task = tasks.get(key)
+        # tasks belong to one event loop, calls from another loop start anew
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            start = time.perf_counter()
+            task = asyncio.ensure_future(obj(*args, **kwargs))
+            tasks[key] = task
+            task.add_done_callback(functools.partial(finish, key, start))
+        return await asyncio.shield(task)
+
+    return memoizer
+
+
+class RetryError(Exception):
+
+    '''
+    Raised by retry once every attempt has failed or the deadline has passed.
+    '''
+
+    def __init__(self, message, *, attempts, last_error=None,
+                 last_result=None):
+        '''
+        @param attempts: how many times the function was called
+        @param last_error: the exception raised by the final attempt, None if
+            it returned an unsuccessful value instead
+        @param last_result: the value returned by the final attempt
+        '''
+        super().__init__(message)
+        self.attempts = attempts
+        self.last_error = last_error
+        self.last_result = last_result
 
-    delay sets the initial delay in seconds, and backoff sets the factor by
-    which the delay should lengthen after each failure. backoff must be greater
-    than 1, or else it isn't really a backoff. tries must be at least 0, and
-    delay greater than 0.
 
-    @raise Exception: upon reaching the final retry, if the underlying method
-        still fails, Exception is raised
+def _retry_delays(delay, backoff, max_delay, jitter):
     '''
+    Yields the seconds to wait before each retry.
 
+    Without jitter the waits grow by backoff from delay.  'full' jitter waits
+    a random time between 0 and that value, 'decorrelated' jitter waits a
+    random time between delay and three times the previous wait.  Every wait
+    is capped at max_delay.
+    '''
+    cap = max_delay if max_delay is not None else float('inf')
+    wait = delay
+    while True:
+        if jitter == 'decorrelated':
+            wait = min(cap, random.uniform(delay, wait * 3))
+            yield wait
+        else:
+            capped = min(cap, wait)
+            yield random.uniform(0, capped) if jitter == 'full' else capped
+            wait *= backoff
+
+
+def _retry_params(tries, delay, backoff, max_delay, jitter, deadline):
+    '''
+    Validates the arguments shared by retry and its async variant.
+
+    @return: tries rounded down to a whole number
+    '''
     if backoff <= 1:
         raise ValueError("backoff must be greater than 1")
 
@@ -67,44 +878,421 @@ def retry(tries, delay=3, backoff=2):
     if delay <= 0:
         raise ValueError("delay must be greater than 0")
 
+    if max_delay is not None and max_delay < delay:
+        raise ValueError("max_delay must not be less than delay")
+
+    if jitter not in (None, 'full', 'decorrelated'):
+        raise ValueError("jitter must be None, 'full' or 'decorrelated'")
+
+    if deadline is not None and deadline <= 0:
+        raise ValueError("deadline must be greater than 0")
+
+    return tries
+
+
+class _Attempts(object):
+
+    '''
+    Tracks the attempts of one call made through retry and decides how long
+    to wait before the next one.
+    '''
+
+    def __init__(self, func, tries, delay, backoff, max_delay, jitter,
+                 deadline):
+        self.func = func
+        self.tries = tries
+        self.deadline = deadline
+        self.start = time.monotonic()
+        self.delays = _retry_delays(delay, backoff, max_delay, jitter)
+        self.count = 0
+
+    def failed(self, *, result=None, error=None):
+        '''
+        Records a failed attempt and returns the seconds to wait before the
+        next one.
+
+        @raise RetryError: if no attempt is left before the tries or the
+            deadline run out
+        '''
+        self.count += 1
+        wait = next(self.delays) if self.count <= self.tries else None
+        if wait is None or (
+                self.deadline is not None and
+                time.monotonic() - self.start + wait > self.deadline):
+            raise RetryError(
+                '{} failed after {} attempts'.format(self.func.__qualname__,
+                                                     self.count),
+                attempts=self.count, last_error=error,
+                last_result=result) from error
+
+        _ROOT_LOGGER.warning(
+            'Attempt {} of {} at {} failed ({}), retrying in {:.2f} '
+            'seconds'.format(self.count, self.tries + 1,
+                             self.func.__qualname__,
+                             error or repr(result), wait))
+        return wait
+
+
+class CircuitOpenError(Exception):
+
+    '''
+    Raised instead of making a call while its target's circuit is open.
+    '''
+
+    def __init__(self, message, *, target, retry_after):
+        '''
+        @param target: the target whose circuit is open
+        @param retry_after: seconds until a probe call will be let through
+        '''
+        super().__init__(message)
+        self.target = target
+        self.retry_after = retry_after
+
+
+class _Circuit(object):
+
+    ''' Failure state of one target of a CircuitBreaker. '''
+
+    __slots__ = ('failures', 'opened', 'probing')
+
+    def __init__(self):
+        self.failures = 0  # consecutive failures
+        self.opened = None  # time.monotonic() when the circuit opened
+        self.probing = False  # a half-open probe call is in progress
+
+
+class CircuitBreaker(object):
+
+    '''
+    Shares failure state between calls to the same target (for example one
+    FTP host), so that once a target is down, calls to it fail straight away
+    instead of each waiting out its own retries.
+
+    A target's circuit opens after failure_threshold consecutive failures.
+    While it is open, calls raise CircuitOpenError without running.  Once
+    reset_timeout seconds have passed it half-opens and lets a single probe
+    call through; a success closes the circuit and a failure opens it again.
+
+    An instance decorates functions and coroutine functions directly
+    (@breaker) and can be given to retry(breaker=...) so that every attempt
+    counts.  It is thread-safe and may be shared by any number of functions.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, *, key=None,
+                 success=bool):
+        '''
+        @param failure_threshold: consecutive failures which open a circuit
+        @param reset_timeout: seconds a circuit stays open before a probe
+        @param key: callable taking the arguments of a decorated call and
+            returning its target, None treats every call as the same target
+        @param success: callable deciding whether a return value is a
+            success, by default any truthy value is.  Raising an exception is
+            always a failure.
+        '''
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be 1 or greater")
+        if reset_timeout <= 0:
+            raise ValueError("reset_timeout must be greater than 0")
+
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout = reset_timeout
+        self.__key = key
+        self.__success = success
+        # target -> _Circuit, closed circuits without failures are dropped
+        self.__circuits = {}
+        self.__lock = threading.Lock()
+
+    def target(self, args, kwargs):
+        ''' Returns the target of a call with these arguments. '''
+        if self.__key is None:
+            return None
+        return self.__key(*args, **kwargs)
+
+    def allow(self, target):
+        '''
+        Checks that a call to target may go ahead.  When a circuit is due to
+        half-open, this call becomes its probe.
+
+        @raise CircuitOpenError: if the circuit is open or already probing
+        '''
+        with self.__lock:
+            circuit = self.__circuits.get(target)
+            if circuit is None or circuit.opened is None:
+                return
+            remaining = (circuit.opened + self.__reset_timeout -
+                         time.monotonic())
+            if remaining > 0 or circuit.probing:
+                raise CircuitOpenError(
+                    'Circuit for {!r} is open'.format(target),
+                    target=target, retry_after=max(remaining, 0))
+            circuit.probing = True
+
+    def record(self, target, success):
+        '''
+        Records the outcome of a call allowed by allow.
+
+        @param success: True or False, or None when the call ended without a
+            verdict (it was cancelled), which only frees a probe
+        '''
+        with self.__lock:
+            circuit = self.__circuits.get(target)
+            if success:
+                self.__circuits.pop(target, None)
+                return
+            if success is None:
+                if circuit is not None:
+                    circuit.probing = False
+                return
+
+            if circuit is None:
+                circuit = self.__circuits[target] = _Circuit()
+            circuit.failures += 1
+            if (circuit.probing or
+                    circuit.failures >= self.__failure_threshold):
+                circuit.opened = time.monotonic()
+            circuit.probing = False
+
+    def state(self, target=None):
+        ''' Returns CLOSED, OPEN or HALF_OPEN for target. '''
+        with self.__lock:
+            circuit = self.__circuits.get(target)
+            if circuit is None or circuit.opened is None:
+                return self.CLOSED
+            if (circuit.probing or time.monotonic() >=
+                    circuit.opened + self.__reset_timeout):
+                return self.HALF_OPEN
+            return self.OPEN
+
+    def reset(self, target=None):
+        ''' Closes the circuit for target. '''
+        with self.__lock:
+            self.__circuits.pop(target, None)
+
+    def __verdict(self, ex):
+        '''
+        Returns the success to record for a call which raised ex: a failure,
+        or no verdict if it was cancelled or interrupted.
+        '''
+        return False if isinstance(ex, Exception) else None
+
+    def __call__(self, func):
+        '''
+        Decorates func so that every call goes through this breaker.
+        '''
+        @functools.wraps(func)
+        def guarded(*args, **kwargs):
+            '''
+            Calls func unless its target's circuit is open.
+            '''
+            target = self.target(args, kwargs)
+            self.allow(target)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as ex:
+                self.record(target, self.__verdict(ex))
+                raise
+            self.record(target, bool(self.__success(result)))
+            return result
+
+        @functools.wraps(func)
+        async def guarded_async(*args, **kwargs):
+            '''
+            Awaits func unless its target's circuit is open.
+            '''
+            target = self.target(args, kwargs)
+            self.allow(target)
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as ex:
+                self.record(target, self.__verdict(ex))
+                raise
+            self.record(target, bool(self.__success(result)))
+            return result
+
+        if inspect.iscoroutinefunction(func):
+            return guarded_async
+        return guarded
+
+
+def _breaker_target(breaker, args, kwargs):
+    ''' Returns the target of a call for breaker, which may be None. '''
+    if breaker is None:
+        return None
+    return breaker.target(args, kwargs)
+
+
+def _breaker_record(breaker, target, success=False, error=None):
+    '''
+    Records the outcome of an attempt with breaker, if there is one.  An
+    attempt which raised error is a failure, or has no verdict if it was
+    cancelled or interrupted.
+    '''
+    if breaker is None:
+        return
+    if error is not None and not isinstance(error, Exception):
+        success = None
+    breaker.record(target, success)
+
+
+def retry(tries, delay=3, backoff=2, *, max_delay=None, jitter=None,
+          exceptions=(), deadline=None, success=bool, sleep=None,
+          breaker=None):
+    '''
+    Retries a function or method until its return value counts as a success,
+    and returns that value.
+
+    delay sets the initial delay in seconds, and backoff sets the factor by
+    which the delay should lengthen after each failure. backoff must be greater
+    than 1, or else it isn't really a backoff. tries must be at least 0, and
+    delay greater than 0.
+
+    Coroutine functions are retried by a coroutine which awaits its waits, so
+    retrying tasks do not block the event loop or hold a thread.  Cancelling
+    the task cancels the attempt or wait in progress.
+
+    @param tries: how many times to retry after the first attempt
+    @param max_delay: cap on any single wait in seconds, None is uncapped
+    @param jitter: None for plain exponential waits, 'full' to wait a random
+        time up to the exponential wait, or 'decorrelated' to wait a random
+        time between delay and three times the previous wait.  Jitter keeps
+        many callers that failed together from retrying in lockstep.
+    @param exceptions: exception types which count as a failed attempt,
+        anything else is raised straight away
+    @param deadline: seconds from the first attempt after which no further
+        attempt is started, None waits for every try
+    @param success: callable deciding whether a return value is a success,
+        by default any truthy value is
+    @param sleep: callable used to wait between attempts, for example the
+        wait method of a threading.Event so a shutdown can cut a wait short.
+        Defaults to time.sleep, or asyncio.sleep for coroutine functions, in
+        which case a replacement must be a coroutine function too.
+    @param breaker: a CircuitBreaker which every attempt goes through, its
+        outcome judged by success rather than the breaker's own.  Once the
+        target's circuit is open, CircuitOpenError is raised straight away
+        instead of waiting out the remaining tries.
+
+    @raise RetryError: upon reaching the final retry, if the underlying method
+        still fails.  Its last_error and last_result attributes (and
+        __cause__) hold the outcome of the final attempt.
+    '''
+    tries = _retry_params(tries, delay, backoff, max_delay, jitter, deadline)
+
     def deco_retry(func):
         '''
         Decorated internal function which calls the actual retry function.
         '''
+        @functools.wraps(func)
         def f_retry(*args, **kwargs):
             '''
             The actual retry function.
             '''
-            mtries, mdelay = tries, delay  # make mutable
-
-            retry_value = func(*args, **kwargs)  # first attempt
-            while mtries > 0:
-                if retry_value is True:  # Done on success
-                    return True
-                mtries -= 1      # consume an attempt
-                print('Waiting {} seconds'.format(mdelay))
-                time.sleep(mdelay)  # wait...
-                mdelay *= backoff  # make future wait longer
-                retry_value = func(*args, **kwargs)  # Try again
-            raise Exception
+            attempts = _Attempts(func, tries, delay, backoff, max_delay,
+                                 jitter, deadline)
+            target = _breaker_target(breaker, args, kwargs)
+            while True:
+                if breaker is not None:
+                    breaker.allow(target)
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException as ex:
+                    _breaker_record(breaker, target, error=ex)
+                    if (isinstance(ex, CircuitOpenError) or
+                            not isinstance(ex, exceptions)):
+                        raise
+                    wait = attempts.failed(error=ex)
+                else:
+                    succeeded = bool(success(result))
+                    _breaker_record(breaker, target, succeeded)
+                    if succeeded:  # Done on success
+                        return result
+                    wait = attempts.failed(result=result)
+                (sleep or time.sleep)(wait)  # wait...
+
+        @functools.wraps(func)
+        async def f_retry_async(*args, **kwargs):
+            '''
+            The actual retry coroutine.
+            '''
+            attempts = _Attempts(func, tries, delay, backoff, max_delay,
+                                 jitter, deadline)
+            target = _breaker_target(breaker, args, kwargs)
+            while True:
+                if breaker is not None:
+                    breaker.allow(target)
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException as ex:
+                    _breaker_record(breaker, target, error=ex)
+                    if (isinstance(ex, CircuitOpenError) or
+                            not isinstance(ex, exceptions)):
+                        raise
+                    wait = attempts.failed(error=ex)
+                else:
+                    succeeded = bool(success(result))
+                    _breaker_record(breaker, target, succeeded)
+                    if succeeded:  # Done on success
+                        return result
+                    wait = attempts.failed(result=result)
+                await (sleep or asyncio.sleep)(wait)  # wait without blocking
+
+        if inspect.iscoroutinefunction(func):
+            return f_retry_async
         return f_retry  # true decorator -> decorated function
     return deco_retry  # @retry(arg[, ...]) -> true decorator
 
 
-def deprecated(func):
+def deprecated(func=None, *, once_per='call_site'):
     '''This is a decorator which can be used to mark functions
     as deprecated. It will result in a warning being emitted
-    when the function is used.'''
-    warnings.simplefilter('always', DeprecationWarning)
+    when the function is used.
+
+    The warning is only emitted the first time each call site runs, or only
+    the first time the function is called at all, after which calls cost
+    little more than an undecorated call.  Whether emitted warnings are shown
+    is left to the warning filters (DeprecationWarning is hidden by default
+    outside __main__, run with -W default to see it).
+
+    Can be used bare (@deprecated) or as @deprecated(once_per='process').
+
+    @param once_per: 'call_site' to warn once for each line calling the
+        function, or 'process' to warn once in total
+    '''
+    if func is None:
+        return functools.partial(deprecated, once_per=once_per)
+    if once_per not in ('call_site', 'process'):
+        raise ValueError("once_per must be 'call_site' or 'process'")
+
+    message = "Call to deprecated function {}.".format(func.__name__)
+
+    if once_per == 'process':
+        warned = False
+
+        @functools.wraps(func)
+        def deprecator(*args, **kwargs):
+            ''' Function which manages DeprecationWarning. '''
+            nonlocal warned
+            if not warned:
+                warned = True
+                warnings.warn(message, category=DeprecationWarning,
+                              stacklevel=2)
+            return func(*args, **kwargs)
+        return deprecator
+
+    call_sites = set()  # (file, line) of every caller warned so far
 
+    @functools.wraps(func)
     def deprecator(*args, **kwargs):
         ''' Function which manages DeprecationWarning. '''
-        warnings.warn("Call to deprecated function {}.".format(func.__name__),
-                      category=DeprecationWarning)
+        caller = sys._getframe(1)  # pylint: disable=protected-access
+        site = (caller.f_code.co_filename, caller.f_lineno)
+        if site not in call_sites:
+            call_sites.add(site)
+            warnings.warn(message, category=DeprecationWarning, stacklevel=2)
         return func(*args, **kwargs)
-    deprecator.__name__ = func.__name__
-    deprecator.__doc__ = func.__doc__
-    deprecator.__dict__.update(func.__dict__)
     return deprecator
 
 
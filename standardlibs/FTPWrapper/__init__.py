@@ -49,7 +49,8 @@ class FTPWrapper(object):
     # pylint: disable=broad-except
     # other exceptions are explicitly caught but if there is a remaining
     # exception, it needs to be logged
-    @retry(5)
+    # jittered so that queued transfers do not hit a host in lockstep
+    @retry(5, max_delay=30, jitter='full')
     def send_file(self, file_to_post, *, name_override=None):
         '''
         This method will take in a file to post via FTP.  This will use this
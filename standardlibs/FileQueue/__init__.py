@@ -2,15 +2,704 @@
 @author: chrcoe
 '''
 
-from collections import deque
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import asyncio
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import lzma
 import math
+import operator
 import os
+import re
+import select
 import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
 
-from standardlibs.Decorators import retry
+from standardlibs.Decorators import DiskCache, retry
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for zstd compressed archives
+    zstandard = None
+
+
+# name of the journal kept in the queue_path when journaling is enabled
+JOURNAL_NAME = '.filequeue.journal'
+# name of the digest index kept in the queue_path when deduplicating
+DIGESTS_NAME = '.filequeue.digests'
+# name of the index of archived files kept in the archive_path for retention
+ARCHIVE_INDEX_NAME = '.filequeue.archive'
+# directory in the queue_path holding one claim directory per worker
+CLAIMS_DIR = '.claims'
+# file in a claim directory whose mtime shows its worker is alive
+LEASE_NAME = '.lease'
+
+
+# ioctl which makes a file share the blocks of another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# outcome of one file of FileQueue.push_many or FileQueue.pop_many,
+# archived_by is the strategy used to archive a popped file
+BatchResult = namedtuple('BatchResult', ['src', 'dst', 'error', 'archived_by'],
+                         defaults=(None,))
+
+
+def _file_size(path):
+    ''' Returns the size of a file, 0 if it cannot be stat'ed. '''
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def _same_dir(path, other):
+    '''
+    Returns whether two paths are the same directory, however they are
+    written (relative, with a trailing slash, through a symlink).
+    '''
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+def _clone_file(src, dst, *, link=True):
+    '''
+    Copies src to dst as cheaply as the filesystems allow: a hardlink if both
+    are on the same filesystem, else a reflink (shared blocks), else an
+    in-kernel copy with copy_file_range, and only then a regular copy.  An
+    existing dst is replaced.
+
+    @param link: set to False to never hardlink, so dst does not change when
+        src is modified in place
+    @return: the strategy used, 'link', 'reflink', 'copy_file_range' or
+        'copy'
+    @raise shutil.SameFileError: if src and dst are the same file, which
+        replacing dst would destroy
+    '''
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(
+            '{!r} and {!r} are the same file'.format(src, dst))
+    if link:
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass  # on another filesystem, or links are not supported
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                         1 << 30):
+                    pass
+                return 'copy_file_range'
+            except OSError:
+                # not supported between these filesystems, start over
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    return 'copy'
+
+
+# compressions archived files can be stored with -> their file extension
+COMPRESSIONS = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+
+
+def _open_compressed(path, mode, compression, level=None):
+    '''
+    Opens a file in binary mode, compressing or decompressing it with one of
+    the COMPRESSIONS, or as it is if compression is None.
+
+    @param level: compression level when writing, None for the default
+    '''
+    writing = 'r' not in mode
+    if compression is None:
+        return open(path, mode)
+    if compression == 'gzip':
+        if level is None:
+            level = 6
+        return gzip.open(path, mode, compresslevel=level)
+    if compression == 'xz':
+        return lzma.open(path, mode, preset=level if writing else None)
+    if zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+    if writing:
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(
+            level=3 if level is None else level))
+    return zstandard.open(path, mode)
+
+
+def open_archived(path):
+    '''
+    Opens an archived file for reading in binary mode, decompressing it if
+    it was compressed by a FileQueue with an archive_compression (going by
+    its extension).
+
+        with open_archived(path) as file_:
+            data = file_.read()
+    '''
+    for compression, extension in COMPRESSIONS.items():
+        if path.endswith(extension):
+            return _open_compressed(path, 'rb', compression)
+    return open(path, 'rb')
+
+
+def _file_digest(path, compression=None):
+    '''
+    Returns the hex blake2b digest of the content of a file, read in 1 MiB
+    chunks and decompressed first if compression is given.
+    '''
+    digest = hashlib.blake2b()
+    with _open_compressed(path, 'rb', compression) as file_:
+        for chunk in iter(lambda: file_.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _prefix_key(path):
+    '''
+    Returns the cheap key files are first compared by, their size and the
+    digest of their first 64 KiB.
+    '''
+    with open(path, 'rb') as file_:
+        size = os.fstat(file_.fileno()).st_size
+        prefix = file_.read(64 * 1024)
+    return size, hashlib.blake2b(prefix, digest_size=16).hexdigest()
+
+
+def date_layout(name):
+    ''' Shards archived files by the day they were archived, YYYY/MM/DD. '''
+    return os.path.join(*time.strftime('%Y-%m-%d').split('-'))
+
+
+def hash_layout(name):
+    '''
+    Shards archived files over 65536 directories, two levels of 256, by a
+    hash of their name.
+    '''
+    bucket = hashlib.blake2b(os.fsencode(name), digest_size=2).hexdigest()
+    return os.path.join(bucket[:2], bucket[2:])
+
+
+# archive layouts which can be given to FileQueue by name
+LAYOUTS = {
+    'date': date_layout,
+    'hash': hash_layout,
+}
+
+
+def fifo_order(path):
+    ''' Orders files first in first out. '''
+    return 0
+
+
+def smallest_first(path):
+    ''' Orders smaller files first, so one huge file cannot hold up the
+    rest. '''
+    return _file_size(path)
+
+
+def oldest_first(path):
+    ''' Orders files by modification time, oldest first. '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def priority_order(*patterns):
+    '''
+    Returns an order which puts files whose name matches an earlier one of
+    the given fnmatch patterns first, and files matching none of them last.
+
+    @param patterns: file name patterns, most urgent first, e.g. '*.urgent'
+    '''
+    matchers = [re.compile(fnmatch.translate(pattern)).match
+                for pattern in patterns]
+
+    def order(path):
+        name = os.path.basename(path)
+        for rank, match in enumerate(matchers):
+            if match(name):
+                return rank
+        return len(matchers)
+    return order
+
+
+# orders which can be given to FileQueue by name
+ORDERS = {
+    'fifo': fifo_order,
+    'smallest': smallest_first,
+    'oldest': oldest_first,
+}
+
+
+class _HeapQueue(object):
+
+    '''
+    The queue of file paths, a heap ordered by order(path) and then by when
+    a path was added, so files with the same order come out first in first
+    out.  Adding and taking a file are O(log n).
+    '''
+
+    def __init__(self, order):
+        self.__order = order
+        self.__heap = []
+        self.__seq = itertools.count()
+        # files put back go in front of those with the same order
+        self.__front = itertools.count(-1, -1)
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def __iter__(self):
+        ''' Yields the paths in the order they were added. '''
+        for _, _, path in sorted(self.__heap, key=operator.itemgetter(1)):
+            yield path
+
+    def append(self, path):
+        ''' Adds a path. '''
+        heapq.heappush(self.__heap,
+                       (self.__order(path), next(self.__seq), path))
+
+    def extend(self, paths):
+        ''' Adds several paths, in one heapify if there are many. '''
+        entries = [(self.__order(path), next(self.__seq), path)
+                   for path in paths]
+        if len(entries) > len(self.__heap):
+            self.__heap.extend(entries)
+            heapq.heapify(self.__heap)
+        else:
+            for entry in entries:
+                heapq.heappush(self.__heap, entry)
+
+    def appendleft(self, path):
+        ''' Puts a path which was taken back. '''
+        heapq.heappush(self.__heap,
+                       (self.__order(path), next(self.__front), path))
+
+    def popleft(self):
+        '''
+        Takes the first path.
+
+        @raise IndexError: if there is none
+        '''
+        return heapq.heappop(self.__heap)[2]
+
+
+class _Histogram(object):
+
+    '''
+    Counts latencies, in seconds, in buckets whose upper bounds double from
+    1 millisecond up to about 17 minutes, plus one for anything longer.
+    '''
+
+    BOUNDS = tuple(0.001 * 2 ** power for power in range(21))
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def observe(self, seconds):
+        ''' Adds one latency. '''
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+    def quantile(self, fraction):
+        '''
+        Returns the upper bound of the bucket holding the given fraction of
+        the latencies (at most the largest one seen), 0.0 if there are none.
+        '''
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        ''' Returns the histogram as a dict. '''
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip(self.BOUNDS + (math.inf,), self.buckets)),
+        }
+
+
+class _Metrics(object):
+
+    '''
+    Counters and latency histograms of the push, pop (the move to the
+    output_path) and archive operations of a FileQueue, plus a histogram of
+    how long files were queued (dwell).  Operations may be recorded from
+    several threads.
+    '''
+
+    OPERATIONS = ('push', 'pop', 'archive')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        for operation in self.OPERATIONS:
+            self.__counters[operation] = 0
+            self.__counters[operation + '_errors'] = 0
+            self.__counters[operation + '_bytes'] = 0
+        self.__latency = {name: _Histogram()
+                          for name in self.OPERATIONS + ('dwell',)}
+
+    def record(self, operation, seconds, size):
+        ''' Records one successful operation on a file of size bytes. '''
+        with self.__lock:
+            self.__counters[operation] += 1
+            self.__counters[operation + '_bytes'] += size
+            self.__latency[operation].observe(seconds)
+
+    def fail(self, operation):
+        ''' Records one failed operation. '''
+        with self.__lock:
+            self.__counters[operation + '_errors'] += 1
+
+    def observe(self, name, seconds):
+        ''' Adds a latency to the named histogram. '''
+        with self.__lock:
+            self.__latency[name].observe(seconds)
+
+    def snapshot(self):
+        ''' Returns the counters and histograms as a dict. '''
+        with self.__lock:
+            return {
+                'counters': dict(self.__counters),
+                'latency': {name: histogram.snapshot()
+                            for name, histogram in self.__latency.items()},
+            }
+
+
+class _ArchiveIndex(object):
+
+    '''
+    Index of the archived files of FileQueues with a retention limit, in a
+    sqlite database which several processes can share.  Files are indexed
+    by the time they were archived, and their total count and size are kept
+    up to date alongside, so checking the limits costs the same however
+    many files there are, and pruning only reads the rows it deletes.
+    '''
+
+    def __init__(self, path, *, max_age=None, max_bytes=None, max_count=None,
+                 timeout=30):
+        self.__max_age = max_age
+        self.__max_bytes = max_bytes
+        self.__max_count = max_count
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, timeout=timeout,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute(
+            'CREATE TABLE IF NOT EXISTS archived (path TEXT PRIMARY KEY, '
+            'size INTEGER NOT NULL, archived REAL NOT NULL)')
+        self.__conn.execute(
+            'CREATE INDEX IF NOT EXISTS archived_time ON archived (archived)')
+        self.__conn.execute(
+            'CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY, '
+            'count INTEGER NOT NULL, bytes INTEGER NOT NULL)')
+        self.__conn.execute(
+            'INSERT OR IGNORE INTO totals VALUES (0, 0, 0)')
+
+    def add(self, path, size):
+        ''' Indexes a file which was just archived. '''
+        with self.__lock:
+            conn = self.__conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # a file archived again under the same name replaces the
+                # earlier one
+                row = conn.execute('SELECT size FROM archived WHERE path = ?',
+                                   (path,)).fetchone()
+                count, replaced = (0, row[0]) if row else (1, 0)
+                conn.execute(
+                    'INSERT OR REPLACE INTO archived VALUES (?, ?, ?)',
+                    (path, size, time.time()))
+                conn.execute('UPDATE totals SET count = count + ?, '
+                             'bytes = bytes + ? WHERE id = 0',
+                             (count, size - replaced))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def totals(self):
+        ''' Returns the number and total size of the indexed files. '''
+        with self.__lock:
+            return self.__conn.execute(
+                'SELECT count, bytes FROM totals WHERE id = 0').fetchone()
+
+    def prune(self, batch=64, keep=None):
+        '''
+        Removes the oldest files, and their rows, for as long as any limit is
+        exceeded, up to batch files per transaction.
+
+        @param keep: the path of a file which is never removed, e.g. the one
+            just archived
+
+        @return: the paths of the files removed
+        '''
+        removed = []
+        while True:
+            with self.__lock:
+                doomed = self.__expire(batch, keep)
+            for path in doomed:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # removed by hand, only the row was left
+            removed.extend(doomed)
+            if len(doomed) < batch:
+                return removed
+
+    def __expire(self, batch, keep=None):
+        '''
+        Deletes the rows of up to batch of the oldest files which are over a
+        limit, other than keep.
+
+        @return: the paths of the deleted rows
+        '''
+        conn = self.__conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            count, total = conn.execute(
+                'SELECT count, bytes FROM totals WHERE id = 0').fetchone()
+            cutoff = None
+            if self.__max_age is not None:
+                cutoff = time.time() - self.__max_age
+            doomed = []
+            freed = 0
+            for path, size, archived in conn.execute(
+                    'SELECT path, size, archived FROM archived '
+                    'WHERE path IS NOT ? ORDER BY archived LIMIT ?',
+                    (keep, batch)).fetchall():
+                if not ((self.__max_count is not None and
+                         count - len(doomed) > self.__max_count) or
+                        (self.__max_bytes is not None and
+                         total - freed > self.__max_bytes) or
+                        (cutoff is not None and archived < cutoff)):
+                    break
+                doomed.append(path)
+                freed += size
+            conn.executemany('DELETE FROM archived WHERE path = ?',
+                             [(path,) for path in doomed])
+            conn.execute('UPDATE totals SET count = count - ?, '
+                         'bytes = bytes - ? WHERE id = 0',
+                         (len(doomed), freed))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return doomed
+
+    def close(self):
+        ''' Closes the database. '''
+        with self.__lock:
+            self.__conn.close()
+
+
+class _ByteBudget(object):
+
+    '''
+    Bounds the bytes of the file transfers in flight on the worker pool.  A
+    transfer larger than the whole budget is let through on its own.
+    '''
+
+    def __init__(self, limit):
+        self.__limit = limit
+        self.__used = 0
+        self.__cond = threading.Condition()
+
+    def acquire(self, size):
+        ''' Blocks until size more bytes fit in the budget. '''
+        with self.__cond:
+            while self.__used and self.__used + size > self.__limit:
+                self.__cond.wait()
+            self.__used += size
+
+    def release(self, size):
+        ''' Returns the bytes of a finished transfer to the budget. '''
+        with self.__cond:
+            self.__used -= size
+            self.__cond.notify_all()
+
+
+class _Lease(object):
+
+    '''
+    The lease of a FileQueue worker on the files it claimed: a file in its
+    claim directory whose modification time is renewed every third of the
+    lease_timeout by a background thread, so the claims are held for as
+    long as the worker runs, however long moving a file takes.
+    '''
+
+    def __init__(self, claim_path, timeout):
+        self.__path = os.path.join(claim_path, LEASE_NAME)
+        self.__interval = timeout / 3
+        self.__closed = threading.Event()
+        self.renew()
+        self.__thread = threading.Thread(target=self.__beat,
+                                         name='FileQueue-lease', daemon=True)
+        self.__thread.start()
+
+    def renew(self):
+        ''' Marks the worker as alive. '''
+        try:
+            os.utime(self.__path)
+        except FileNotFoundError:
+            open(self.__path, 'a').close()
+
+    def __beat(self):
+        ''' Renews the lease until closed. '''
+        while not self.__closed.wait(self.__interval):
+            try:
+                self.renew()
+            except OSError:
+                logging.getLogger('rootLogger').error(
+                    'Error renewing lease:\t{}'.format(self.__path),
+                    exc_info=True)
+
+    def close(self):
+        ''' Stops renewing the lease, which then expires. '''
+        self.__closed.set()
+        self.__thread.join()
+
+
+class _InotifyWatcher(object):
+
+    '''
+    Reports files which were closed after writing in, or moved into, a
+    directory using the Linux inotify API.
+    '''
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len then the name
+
+    def __init__(self, path, wake_fd):
+        '''
+        @param wake_fd: a pipe which makes wait return early when written to
+        @raise OSError: if inotify is not available
+        '''
+        self.__wake_fd = wake_fd
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.__fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.__fd, os.fsencode(path),
+                                  self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.__fd)
+            raise OSError(err, os.strerror(err), path)
+
+    def wait(self, timeout):
+        '''
+        Waits up to timeout seconds (None is forever) for files.
+
+        @return: list of file names, or None if events were lost and the
+            directory has to be scanned
+        '''
+        readable, _, _ = select.select([self.__fd, self.__wake_fd], [], [],
+                                       timeout)
+        if self.__wake_fd in readable:
+            os.read(self.__wake_fd, 4096)
+            return []
+        if not readable:
+            return []
+        data = os.read(self.__fd, 64 * 1024)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if not mask & self.IN_ISDIR:
+                names.append(os.fsdecode(
+                    data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        ''' Stops watching. '''
+        os.close(self.__fd)
+
+
+class _PollingWatcher(object):
+
+    '''
+    Stands in for _InotifyWatcher where inotify is not available by asking
+    for a scan of the directory every interval seconds.
+    '''
+
+    def __init__(self, interval, stopping):
+        '''
+        @param stopping: a threading.Event which ends the wait early
+        '''
+        self.__interval = interval
+        self.__stopping = stopping
+
+    def wait(self, timeout):
+        '''
+        Sleeps for the polling interval, or timeout if that is shorter.
+
+        @return: None, the directory always has to be scanned
+        '''
+        if timeout is None or timeout > self.__interval:
+            timeout = self.__interval
+        self.__stopping.wait(timeout)
+        return None
+
+    def close(self):
+        ''' Nothing to release. '''
 
 
 class FileQueue(object):
@@ -20,7 +709,16 @@ class FileQueue(object):
     according to the file paths passed in during instantiation.
     '''
 
-    def __init__(self, input_path, output_path, queue_path, archive_path):
+    def __init__(self, input_path, output_path, queue_path, archive_path, *,
+                 journal=False, worker_id=None, lease_timeout=300,
+                 archive_link=True, workers=None,
+                 max_inflight_bytes=256 * 1024 * 1024, order='fifo',
+                 quiet_period=None, metrics_exporter=None,
+                 metrics_interval=60, dedup=False, dedup_maxsize=100000,
+                 archive_layout=None, archive_compression=None,
+                 compression_level=None, compression_workers=1,
+                 archive_max_age=None, archive_max_bytes=None,
+                 archive_max_count=None, retry_interval=60):
         '''
         Creates a FileQueue object to track files coming in and going out.
         Instantiation ensures that these folders exist and sets up the queue
@@ -31,6 +729,90 @@ class FileQueue(object):
             finished
         @param queue_path: path where files should be stored while waiting to
             be processed
+        @param journal: if True, every push and pop is appended to a journal
+            in the queue_path, and a new FileQueue on the same queue_path
+            recovers the queue in its original order, for example after a
+            crash.  Files found in the queue_path which the journal does not
+            know about are added to the end, oldest first.
+        @param worker_id: set to a name unique to this worker to let several
+            processes pop from the same queue_path.  Each pop claims a file
+            by renaming it into the worker's own directory under the
+            queue_path, which only one worker can do, so no file is popped
+            twice.  Files pushed by any worker are popped oldest first.
+            Cannot be combined with journal, the queue_path itself is the
+            shared state.
+        @param lease_timeout: seconds after which the claimed files of a
+            worker which stopped popping (it crashed between claiming a file
+            and moving it out, or was closed) are put back on the queue.
+            The lease is renewed in the background until close, so moving a
+            file may take longer than this.
+        @param archive_link: if True, popped files are archived as hardlinks
+            when the output_path and archive_path share a filesystem, so no
+            data is copied.  Set to False if popped files are modified in
+            place, which would change a hardlinked archive too.  Otherwise
+            reflinks and copy_file_range are tried before a regular copy.
+        @param workers: number of threads push_many and pop_many use to move
+            and archive files, which pays off when the paths are on
+            different filesystems and every file is copied.  None does the
+            transfers one after the other on the calling thread.
+        @param max_inflight_bytes: with workers, the most bytes of files
+            being transferred at the same time
+        @param order: the order files are popped in, 'fifo', 'smallest'
+            (smallest file first), 'oldest' (oldest modification time
+            first), or a function returning a sort key for the path of a
+            file on the queue_path, such as priority_order('*.urgent').
+            Files with equal keys are popped first in first out.
+        @param quiet_period: if set, check_dir and watch only push a file
+            from the input_path once its size and modification time have
+            not changed for this many seconds, so files still being
+            uploaded are left alone.  watch also pushes a file as soon as
+            inotify reports it was closed after writing or moved in.
+        @param metrics_exporter: a function which is passed the result of
+            metrics about every metrics_interval seconds while the queue is
+            in use, and once more on close, e.g. to push them to a
+            monitoring system
+        @param metrics_interval: seconds between calls of metrics_exporter
+        @param dedup: if True, a file with the same content as one pushed
+            before is removed from the input_path instead of being pushed.
+            Files are compared by size and the start of their content first
+            and only hashed in full when that matches, against an index of
+            earlier files kept in the queue_path which outlives the queue.
+            The index points at the archived copy of a popped file to hash
+            it when needed, so a file whose archived copy is gone is no
+            longer recognized.  Empty files are never skipped.
+        @param dedup_maxsize: the most files the index remembers, the ones
+            not seen for the longest time are forgotten first
+        @param archive_layout: None archives all files directly in the
+            archive_path.  'date' puts them in YYYY/MM/DD directories by the
+            day they are archived and 'hash' in two levels of 256
+            directories by a hash of their name, so no directory grows
+            without bounds.  A function returning the relative directory
+            for a file name can be given instead.  Directories are created
+            the first time a file goes in.
+        @param archive_compression: 'gzip', 'xz' or 'zstd' (needs the
+            zstandard package) to store archived files compressed, with the
+            extension of the compression added to their name.  Popped files
+            are compressed on background threads from a hardlink (or copy)
+            made when they are popped, so pop does not wait for them, and
+            close waits for all of them.  Use open_archived to read them.
+            Files popped into the archive_path itself are not compressed.
+        @param compression_level: the compression level, None for the
+            default of the compression
+        @param compression_workers: number of threads compressing files
+        @param archive_max_age: seconds after which archived files are
+            removed.  With any of the archive_max_ limits, archived files
+            are recorded in an index in the archive_path and the oldest ones
+            over a limit are removed whenever a file is archived, or when
+            prune_archive is called.  Only files archived while a limit was
+            set are ever removed, and directories are left in place.
+        @param archive_max_bytes: the most bytes of archived files to keep,
+            the oldest are removed first
+        @param archive_max_count: the most archived files to keep, the
+            oldest are removed first
+        @param retry_interval: seconds check_dir, watch and stream wait
+            before trying again to push a file which is still in the
+            input_path unchanged after failing to push.  A changed file is
+            tried again straight away.
         '''
 
         self.__root_logger = logging.getLogger('rootLogger')
@@ -64,7 +846,98 @@ class FileQueue(object):
         os.makedirs(self.__output_path, exist_ok=True)
 
         # this is a queue which will hold the file locations as strings
-        self.__q = deque([])
+        if isinstance(order, str):
+            try:
+                order = ORDERS[order]
+            except KeyError:
+                raise ValueError('Unknown order: {}'.format(order))
+        self.__q = _HeapQueue(order)
+        # input file name -> ((inode, mtime_ns, size), time.monotonic()) when
+        # it was last yielded, files still there unchanged (their push
+        # failed) are skipped until retry_interval has passed
+        self.__seen = {}
+        self.__retry_interval = retry_interval
+        self.__quiet_period = quiet_period
+        # input file name -> ((inode, mtime_ns, size), time.monotonic()) when
+        # it was first found like that, for files not quiet for long enough
+        self.__pending = {}
+        # set by stop to end watch and stream, which select on the read end
+        # of the wake pipe while waiting for inotify
+        self.__stopping = threading.Event()
+        self.__wake = None
+
+        self.__metrics = _Metrics()
+        # queue file name -> time.time() it was queued, for the dwell time
+        self.__enqueued = {}
+        self.__metrics_exporter = metrics_exporter
+        self.__metrics_interval = metrics_interval
+        self.__next_export = time.monotonic() + metrics_interval
+
+        self.__digests = None
+        if dedup:
+            self.__digests = DiskCache(
+                os.path.join(self.__queue_path, DIGESTS_NAME),
+                maxsize=dedup_maxsize)
+            # queue file name -> its key in the digest index
+            self.__digest_keys = {}
+            # a file is looked up, moved and indexed holding the lock for
+            # its key, so identical files pushed at once on the worker pool
+            # cannot all miss each other
+            self.__digest_locks = [threading.Lock() for _ in range(64)]
+
+        self.__worker_id = worker_id
+        self.__lease_timeout = lease_timeout
+        self.__lease = None
+        self.__archive_link = archive_link
+        if isinstance(archive_layout, str):
+            try:
+                archive_layout = LAYOUTS[archive_layout]
+            except KeyError:
+                raise ValueError(
+                    'Unknown archive layout: {}'.format(archive_layout))
+        self.__archive_layout = archive_layout
+        if archive_compression is not None:
+            if archive_compression not in COMPRESSIONS:
+                raise ValueError('Unknown archive compression: {}'.format(
+                    archive_compression))
+            if archive_compression == 'zstd' and zstandard is None:
+                raise ValueError(
+                    'zstd compression needs the zstandard package')
+        self.__compression = archive_compression
+        self.__compressor = None
+        if archive_compression is not None:
+            self.__compressor = ThreadPoolExecutor(
+                compression_workers, thread_name_prefix='FileQueue')
+        self.__compression_level = compression_level
+        self.__retention = None
+        if (archive_max_age is not None or archive_max_bytes is not None or
+                archive_max_count is not None):
+            self.__retention = _ArchiveIndex(
+                os.path.join(self.__archive_path, ARCHIVE_INDEX_NAME),
+                max_age=archive_max_age, max_bytes=archive_max_bytes,
+                max_count=archive_max_count)
+        # archive directories known to exist
+        self.__archive_dirs = set()
+        self.__pool = None
+        if workers:
+            self.__pool = ThreadPoolExecutor(workers,
+                                             thread_name_prefix='FileQueue')
+            self.__inflight = _ByteBudget(max_inflight_bytes)
+        if worker_id is not None:
+            if journal:
+                raise ValueError('journal cannot be used with worker_id')
+            self.__claim_path = os.path.join(self.__queue_path, CLAIMS_DIR,
+                                             worker_id)
+            os.makedirs(self.__claim_path, exist_ok=True)
+            self.__lease = _Lease(self.__claim_path, lease_timeout)
+            # claims left over from an earlier run of this worker
+            self.__release_claims(self.__claim_path)
+
+        self.__journal = None
+        if journal:
+            self.__journal_path = os.path.join(self.__queue_path,
+                                               JOURNAL_NAME)
+            self.__recover()
 
     def get_queue_path(self):
         ''' Returns the internally set queue_path. '''
@@ -83,29 +956,42 @@ class FileQueue(object):
         ''' Sets the internal archive_path and creates the directory. '''
         self.__archive_path = value
         os.makedirs(self.__archive_path, exist_ok=True)
+        self.__archive_dirs = set()
 
-    # pylint: disable=broad-except
-    # We need to catch all remaining exceptions if the file move fails.
-    @retry(5)  # exponential backoff, 5 tries:-> 3,6,12,24,48 (seconds)
     def push(self, in_file):
         '''
         Puts the given file onto the queue_path and returns True if successful.
+        With dedup, a duplicate which was removed instead counts as success.
 
         @param in_file: the file to put onto the queue
         '''
+        return self.__push_file(in_file) is not False
+
+    # pylint: disable=broad-except
+    # We need to catch all remaining exceptions if the file move fails.
+    # exponential backoff, 5 tries:-> up to 3,6,12,24,30 (seconds), jittered
+    @retry(5, max_delay=30, jitter='full',
+           success=lambda result: result is not False)
+    def __push_file(self, in_file):
+        '''
+        Does the work of push.
+
+        @return: the path of the file on the queue_path, None if it was a
+            duplicate and removed, or False if it could not be pushed
+        '''
+        self.__export_metrics()
         try:
             # take this file OUT of the PATH_INPUT
             src = in_file
-            dst = os.path.join(os.path.dirname(in_file), self.__queue_path,
-                               os.path.basename(in_file))
+            dst = self.__queue_unique(src)
+            if dst is None:
+                return None
             # and put it INTO the QUEUE_PATH
             self.__root_logger.info(
                 'Pushing file to FileQueue:\t{}'.format(os.path.basename(dst)))
             print('moving to QUEUE_PATH:\t', dst)
             # and store its location on the internal queue object
-
-            self.__q.append(shutil.move(src, dst))
-            return True
+            self.__enqueue(dst)
         except Exception:
             self.__root_logger.error(
                 'Error during pushing file on to FileQueue')
@@ -113,6 +999,29 @@ class FileQueue(object):
                 'Error during pushing file on to FileQueue', exc_info=True)
 #             print(e)
             return False
+        self.__journal_append('+', dst)
+        return dst
+
+    def push_many(self, in_files):
+        '''
+        Puts several files onto the queue_path in one go.  Unlike push, a file
+        which cannot be moved is neither retried nor stops the rest of the
+        batch, and the batch is logged (and journaled) once.
+
+        @param in_files: the files to put onto the queue
+        @return: a BatchResult(src, dst, error) per file in the given order,
+            dst is None and error the exception for files which failed, dst
+            and error are None for duplicates which were skipped
+        '''
+        self.__export_metrics()
+        results = self.__transfer(
+            (src, lambda src=src: self.__push_one(src)) for src in in_files)
+        pushed = [result.dst for result in results if result.dst is not None]
+
+        self.__enqueue(*pushed)
+        self.__journal_append('+', *pushed)
+        self.__log_batch('Pushed', results)
+        return results
 
     def pop(self, *, addtimestamp=True):
         '''
@@ -122,66 +1031,893 @@ class FileQueue(object):
         @param addtimestamp: if true, adds a date/time stamp to the filename
             when saving it on the output_path
         '''
+        self.__export_metrics()
         # take a single file OUT of the QUEUE_PATH
         try:
             # get the file loc from the internal queue
-            src = self.__q.popleft()
-            file_name, file_ext = os.path.splitext(src)
-
-            if addtimestamp:
-                # timestamp
-                timestamp = datetime.fromtimestamp(
-                    time.time()).strftime('%Y%m%d_%H%M%S')
-                stamped_src = '.'.join(('{filename}-{datetimestamp}'.format(
-                    filename=os.path.basename(file_name),
-                    datetimestamp=timestamp), file_ext[1:]))
-            else:
-                stamped_src = '.'.join(('{filename}'.format(
-                    filename=os.path.basename(file_name)), file_ext[1:]))
-
-            # and move to the PATH_OUTPUT
-            dst = os.path.join(self.__output_path, stamped_src)
-            print('just popped file')
-            # move the file to output_path
-            dst = shutil.move(src, dst)
-            # archive it to the archive_path
-            arc_dst = self.__archive_file(in_file=dst)
-            if arc_dst:
-                dst = arc_dst
-
-            # return path of file
-            return dst
+            src = self.__take()
         except IndexError:
             return None
 
+        print('just popped file')
+        # move the file to output_path
+        dst = self.__output_file(
+            src, self.__timestamp() if addtimestamp else None)
+        self.__journal_append('-', src)
+        # archive it to the archive_path
+        arc_dst, strategy = self.__archive_file(in_file=dst)
+        self.__index_archived(src, arc_dst, strategy)
+        if strategy == 'move':
+            dst = arc_dst
+
+        # return path of file
+        return dst
+
+    def pop_many(self, count, *, addtimestamp=True):
+        '''
+        Pops up to count files off of the queue.  All files of the batch share
+        one date/time stamp and the batch is logged (and journaled) once.  A
+        file which fails to move to the output_path is put back on the queue
+        without stopping the rest of the batch.
+
+        @param count: the most files to pop
+        @param addtimestamp: if true, adds a date/time stamp to the filenames
+            when saving them on the output_path
+        @return: a BatchResult(src, dst, error) per file in pop order, dst is
+            the path pop would have returned (None if the file was put back)
+            and error the exception for files which failed
+        '''
+        self.__export_metrics()
+        timestamp = self.__timestamp() if addtimestamp else None
+        taken = []
+        for _ in range(count):
+            try:
+                taken.append(self.__take())
+            except IndexError:
+                break
+        results = self.__transfer(
+            (src, lambda src=src: self.__pop_one(src, timestamp))
+            for src in taken)
+
+        # back in front of the queue in their original order
+        for result in reversed(results):
+            if result.dst is None:
+                self.__untake(result.src)
+        popped = [result.src for result in results if result.dst is not None]
+        self.__journal_append('-', *popped)
+        self.__log_batch('Popped', results)
+        return results
+
+    @staticmethod
+    def __timestamp():
+        ''' Returns the date/time stamp added to popped file names. '''
+        return datetime.fromtimestamp(time.time()).strftime('%Y%m%d_%H%M%S')
+
+    def __output_file(self, src, timestamp):
+        '''
+        Moves a file taken off of the queue to the output_path.
+
+        @param timestamp: date/time stamp to add to the file name, or None
+        @return: the new path of the file
+        '''
+        file_name, file_ext = os.path.splitext(src)
+
+        if timestamp:
+            stamped_src = '.'.join(('{filename}-{datetimestamp}'.format(
+                filename=os.path.basename(file_name),
+                datetimestamp=timestamp), file_ext[1:]))
+        else:
+            stamped_src = '.'.join(('{filename}'.format(
+                filename=os.path.basename(file_name)), file_ext[1:]))
+
+        # and move to the PATH_OUTPUT
+        dst = os.path.join(self.__output_path, stamped_src)
+        size = _file_size(src)
+        started = time.perf_counter()
+        try:
+            dst = self.__move(src, dst)
+        except Exception:
+            self.__metrics.fail('pop')
+            raise
+        self.__metrics.record('pop', time.perf_counter() - started, size)
+        queued = self.__enqueued.pop(os.path.basename(src), None)
+        if queued is not None:
+            self.__metrics.observe('dwell', time.time() - queued)
+        return dst
+
+    def __queue_file(self, src):
+        '''
+        Moves a file onto the queue_path.
+
+        @return: the new path of the file
+        '''
+        dst = os.path.join(os.path.dirname(src), self.__queue_path,
+                           os.path.basename(src))
+        size = _file_size(src)
+        started = time.perf_counter()
+        try:
+            dst = self.__move(src, dst)
+        except Exception:
+            self.__metrics.fail('push')
+            raise
+        self.__metrics.record('push', time.perf_counter() - started, size)
+        return dst
+
+    def __queue_unique(self, src):
+        '''
+        Moves a file onto the queue_path, unless dedup is on and it is a
+        duplicate, which is removed instead.
+
+        @return: the new path of the file, None for a duplicate
+        '''
+        if self.__digests is None:
+            return self.__queue_file(src)
+        key = _prefix_key(src)
+        if not key[0]:
+            # empty files are usually markers, keep them all
+            return self.__queue_file(src)
+        with self.__digest_lock(key):
+            indexed = self.__check_duplicate(src, key)
+            if indexed is None:
+                return None
+            dst = self.__queue_file(src)
+            try:
+                self.__index_file(dst, key, *indexed)
+            except Exception:
+                # the file is queued all the same, it is only not recognized
+                # as the original of later duplicates
+                self.__root_logger.error(
+                    'Error indexing pushed file:\t{}'.format(
+                        os.path.basename(dst)), exc_info=True)
+        return dst
+
+    def __digest_lock(self, key):
+        ''' Returns the lock for a key of the digest index. '''
+        return self.__digest_locks[hash(key) % len(self.__digest_locks)]
+
+    def __check_duplicate(self, src, key):
+        '''
+        Looks a file which is about to be pushed up in the digest index.  A
+        duplicate is removed.
+
+        @return: None if the file was a duplicate, else the arguments for
+            __index_file after the key once the file is on the queue_path
+        '''
+        candidates = self.__digests.get(key)
+        if not candidates:
+            return [], None
+
+        # same size and start, so compare the whole content
+        digest = _file_digest(src)
+        for candidate in candidates:
+            if candidate[0] is None:
+                try:
+                    candidate[0] = _file_digest(*candidate[1:])
+                except OSError:
+                    continue  # gone, can only be compared once known
+            if candidate[0] == digest:
+                self.__digests.set(key, candidates)
+                os.remove(src)
+                self.__root_logger.info(
+                    'Skipped duplicate of {}:\t{}'.format(
+                        os.path.basename(candidate[1]),
+                        os.path.basename(src)))
+                return None
+        return candidates, digest
+
+    def __index_file(self, path, key, candidates, digest):
+        '''
+        Adds a file pushed onto the queue_path to the digest index under its
+        key.  Its digest is left out (None) if it was not needed yet.
+        '''
+        # the most recent few files with the same size and start
+        candidates = candidates[-7:] + [[digest, path]]
+        self.__digests.set(key, candidates)
+        self.__digest_keys[os.path.basename(path)] = key
+
+    def __index_archived(self, src, archived, strategy):
+        '''
+        Points the digest index entry of a popped file at its archived copy,
+        which stays around to be hashed, and records its compression.
+        '''
+        if self.__digests is None:
+            return
+        key = self.__digest_keys.pop(os.path.basename(src), None)
+        if key is None:
+            return
+        name = os.path.basename(src)
+        compression = strategy if strategy in COMPRESSIONS else None
+        with self.__digest_lock(key):
+            candidates = self.__digests.get(key)
+            if not candidates:
+                return
+            for candidate in candidates:
+                if os.path.basename(candidate[1]) == name:
+                    candidate[1:] = [archived, compression]
+            self.__digests.set(key, candidates)
+
+    def __enqueue(self, *paths):
+        ''' Adds files on the queue_path to the queue. '''
+        now = time.time()
+        for path in paths:
+            self.__enqueued.setdefault(os.path.basename(path), now)
+        self.__q.extend(paths)
+
+    @staticmethod
+    def __move(src, dst):
+        '''
+        Moves src to dst with a single rename where possible, falling back
+        to shutil.move (a copy) across filesystems.
+        '''
+        try:
+            os.rename(src, dst)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            return shutil.move(src, dst)
+        return dst
+
+    def __push_one(self, src):
+        ''' Moves one file of push_many onto the queue_path. '''
+        # pylint: disable=broad-except
+        # any error is reported for its file without stopping the batch
+        try:
+            dst = self.__queue_unique(src)
+        except Exception as ex:
+            return BatchResult(src, None, ex)
+        return BatchResult(src, dst, None)
+
+    def __pop_one(self, src, timestamp):
+        ''' Moves one file of pop_many to the output_path and archives it. '''
+        # pylint: disable=broad-except
+        # any error is reported for its file without stopping the batch
+        try:
+            dst = self.__output_file(src, timestamp)
+        except Exception as ex:
+            return BatchResult(src, None, ex)
+        try:
+            arc_dst, strategy = self.__archive_file(in_file=dst, log=False)
+        except Exception as ex:
+            # the file did reach the output_path
+            return BatchResult(src, dst, ex)
+        if strategy == 'move':
+            dst = arc_dst
+        try:
+            self.__index_archived(src, arc_dst, strategy)
+        except Exception as ex:
+            # the file did reach the output_path and is archived
+            return BatchResult(src, dst, ex, strategy)
+        return BatchResult(src, dst, None, strategy)
+
+    def __transfer(self, jobs):
+        '''
+        Runs the (src, job) pairs of a batch, on the worker pool if there is
+        one, waiting for room in the in-flight budget for the size of each
+        src before submitting its job.
+
+        @return: the results of the jobs in the order they were given
+        '''
+        if self.__pool is None:
+            return [job() for _, job in jobs]
+
+        futures = []
+        for src, job in jobs:
+            try:
+                size = os.stat(src).st_size
+            except OSError:
+                size = 0  # the job reports the error
+            self.__inflight.acquire(size)
+            future = self.__pool.submit(job)
+            future.add_done_callback(
+                lambda _, size=size: self.__inflight.release(size))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def __log_batch(self, action, results):
+        ''' Logs the outcome of a batch with one line plus one per error. '''
+        failed = [result for result in results if result.error is not None]
+        self.__root_logger.info('{} {} of {} files on FileQueue'.format(
+            action, len(results) - len(failed), len(results)))
+        for result in failed:
+            self.__root_logger.error('{} failed for {}:\t{}'.format(
+                action, os.path.basename(result.src), result.error))
+
+    def __take(self):
+        '''
+        Takes the next file off of the queue.  With a worker_id the file is
+        claimed first, trying the next one whenever another worker was faster.
+
+        @return: path of the file
+        @raise IndexError: if the queue is empty
+        '''
+        if self.__worker_id is None:
+            return self.__q.popleft()
+
+        self.__lease.renew()
+        for refill in (False, True):
+            if refill:
+                self.__reclaim_expired()
+                self.__enqueue(*self.__scan_queue())
+            while self.__q:
+                src = self.__q.popleft()
+                claimed = os.path.join(self.__claim_path,
+                                       os.path.basename(src))
+                try:
+                    os.rename(src, claimed)
+                except FileNotFoundError:
+                    # claimed by another worker
+                    self.__enqueued.pop(os.path.basename(src), None)
+                    continue
+                return claimed
+        raise IndexError('pop from an empty FileQueue')
+
+    def __untake(self, src):
+        '''
+        Puts a file taken by __take back at the front of the queue.
+        '''
+        if self.__worker_id is None:
+            self.__q.appendleft(src)
+            return
+        queued = os.path.join(self.__queue_path, os.path.basename(src))
+        try:
+            os.rename(src, queued)
+        except FileNotFoundError:
+            return  # the claimed file is gone, nothing to put back
+        self.__q.appendleft(queued)
+
+    def __scan_queue(self):
+        '''
+        Returns the paths of the files in the queue_path, oldest first.
+        '''
+        with os.scandir(self.__queue_path) as entries:
+            files = [(entry.stat().st_mtime_ns, entry.path)
+                     for entry in entries
+                     if entry.is_file() and not entry.name.startswith('.')]
+        files.sort()
+        return [path for _, path in files]
+
+    def __reclaim_expired(self):
+        '''
+        Puts the claimed files of workers whose lease expired back on the
+        queue_path.
+        '''
+        expired = time.time() - self.__lease_timeout
+        with os.scandir(os.path.join(self.__queue_path, CLAIMS_DIR)) as dirs:
+            for claim_dir in dirs:
+                if claim_dir.path == self.__claim_path:
+                    continue
+                try:
+                    renewed = os.stat(
+                        os.path.join(claim_dir.path, LEASE_NAME)).st_mtime
+                except FileNotFoundError:
+                    renewed = 0
+                if renewed < expired:
+                    self.__release_claims(claim_dir.path)
+
+    def __release_claims(self, claim_path):
+        '''
+        Moves the files claimed in claim_path back onto the queue_path.
+        '''
+        with os.scandir(claim_path) as entries:
+            for entry in entries:
+                if entry.name == LEASE_NAME:
+                    continue
+                try:
+                    os.rename(entry.path,
+                              os.path.join(self.__queue_path, entry.name))
+                except FileNotFoundError:
+                    continue  # released by another worker
+                self.__root_logger.warning(
+                    'Released expired claim on:\t{}'.format(entry.name))
+
     def check_dir(self):
         '''
         This will check the input_path directory for files.  If any files are
         found, it will push them onto the queue.
         '''
         is_new_file = False
-        os.chdir(self.__input_path)
-        # check if there is a file in PATH_INPUT
-        for file_ in os.listdir(path=self.__input_path):
-            if os.path.isfile(file_):
-                self.__root_logger.info('File found:\t{}'.format(file_))
-                # and PUSH it to the queue
-                is_new_file = self.push(os.path.join(self.__input_path, file_))
+        # check if there is a new file in PATH_INPUT
+        for file_ in self.__scan_input():
+            self.__root_logger.info(
+                'File found:\t{}'.format(os.path.basename(file_)))
+            # and PUSH it to the queue, unless it is a duplicate
+            is_new_file = bool(self.__push_file(file_))
         return is_new_file
 
-    def __archive_file(self, in_file):
+    def __scan_input(self):
+        '''
+        Yields the paths of files in the input_path which are new, which
+        changed since an earlier scan found them and they were left in place,
+        or which were left in place unchanged for the retry_interval.
+
+        The file type comes from the directory listing via os.scandir, so
+        only regular files are stat'ed, and files a previous pass could not
+        push are not tried again on every pass.
+        '''
+        seen = self.__seen
+        present = set()
+        now = time.monotonic()
+        with os.scandir(self.__input_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                present.add(entry.name)
+                stat = entry.stat()
+                signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                last = seen.get(entry.name)
+                if (last is not None and last[0] == signature and
+                        now - last[1] < self.__retry_interval):
+                    continue
+                if (self.__quiet_period is not None and
+                        not self.__is_quiet(entry.name, signature)):
+                    continue
+                seen[entry.name] = (signature, now)
+                yield entry.path
+
+        # forget files which are gone, most of them were pushed
+        for name in seen.keys() - present:
+            del seen[name]
+        for name in self.__pending.keys() - present:
+            del self.__pending[name]
+
+    def __is_quiet(self, name, signature):
+        '''
+        Returns True if a file in the input_path has not been written to for
+        the quiet_period, going by its modification time or, if that is off
+        (clocks of a network filesystem), by how long it has been found
+        unchanged.
+        '''
+        if time.time() - signature[1] / 1e9 >= self.__quiet_period:
+            self.__pending.pop(name, None)
+            return True
+        now = time.monotonic()
+        found = self.__pending.get(name)
+        if found is None or found[0] != signature:
+            self.__pending[name] = (signature, now)
+            return False
+        if now - found[1] >= self.__quiet_period:
+            del self.__pending[name]
+            return True
+        return False
+
+    def watch(self, *, timeout=None, poll_interval=1.0, inotify=True):
+        '''
+        Pushes files onto the queue as they arrive in the input_path and
+        yields their paths on the queue_path.  Files already in the
+        input_path are pushed first.
+
+        On Linux the input_path is watched with inotify, so a file is picked
+        up as soon as it is closed after writing or moved in, without
+        scanning the directory.  Elsewhere the directory is scanned every
+        poll_interval seconds.  With a quiet_period, files found by a scan
+        while still being written are scanned for again until they are
+        quiet.
+
+        @param timeout: stop once no file has arrived for this many seconds,
+            None watches until the caller stops iterating or calls stop
+        @param poll_interval: seconds between scans when polling
+        @param inotify: set to False to always poll
+        '''
+        watcher = self.__watcher(poll_interval, inotify)
+        try:
+            names = None  # start with a scan for files already there
+            last_file = time.monotonic()
+            while names is not False:
+                for src in self.__arrived(names):
+                    dst = os.path.isfile(src) and self.__push_file(src)
+                    if dst:
+                        last_file = time.monotonic()
+                        yield dst
+                names = self.__wait_input(watcher, last_file, timeout)
+        finally:
+            watcher.close()
+
+    def stream(self, *, timeout=None, addtimestamp=True, poll_interval=1.0,
+               inotify=True):
+        '''
+        Pops files and yields the paths pop returns, waiting for files to
+        arrive in the input_path (as watch does) whenever the queue is
+        empty.  Files already on the queue come first.
+
+        The input_path is only looked at again once the queue is empty, so
+        a consumer which falls behind holds back the pushing of new files
+        rather than letting them pile up on the queue_path.
+
+            for path in file_q.stream():
+                process(path)
+
+        @param timeout: stop once no file has arrived for this many seconds,
+            None streams until the caller stops iterating or calls stop
+        @param addtimestamp: passed on to pop
+        @param poll_interval: seconds between scans when polling
+        @param inotify: set to False to always poll
+        '''
+        watcher = self.__watcher(poll_interval, inotify)
+        try:
+            names = None
+            last_file = time.monotonic()
+            while names is not False:
+                path = self.pop(addtimestamp=addtimestamp)
+                if path is not None:
+                    last_file = time.monotonic()
+                    yield path
+                    if self.__stopping.is_set():
+                        return
+                    continue
+                # the queue is empty, push what arrived meanwhile
+                pushed = False
+                for src in self.__arrived(names):
+                    if os.path.isfile(src) and self.__push_file(src):
+                        pushed = True
+                if pushed:
+                    names = []
+                else:
+                    names = self.__wait_input(watcher, last_file, timeout)
+        finally:
+            watcher.close()
+
+    async def astream(self, **kwargs):
+        '''
+        Asynchronous version of stream taking the same arguments.  The
+        waiting is done on a thread of its own, so the event loop is free
+        meanwhile.  Leaving the loop, or cancelling the task, stops the
+        stream once the file being popped is done.
+
+            async for path in file_q.astream(timeout=60):
+                await process(path)
+        '''
+        loop = asyncio.get_running_loop()
+        paths = self.stream(**kwargs)
+        executor = ThreadPoolExecutor(1, thread_name_prefix='FileQueue')
+        try:
+            while True:
+                path = await loop.run_in_executor(executor, next, paths, None)
+                if path is None:
+                    return
+                yield path
+        finally:
+            self.stop()
+            # runs once a next still going on the thread returned
+            executor.submit(paths.close)
+            executor.shutdown(wait=False)
+
+    def stop(self):
+        '''
+        Ends watch and stream, waking them if they are waiting for files.
+        A file being pushed or popped is finished first.  Safe to call from
+        other threads and signal handlers.
+        '''
+        self.__stopping.set()
+        if self.__wake is not None:
+            try:
+                os.write(self.__wake[1], b'\0')
+            except OSError:
+                pass  # the pipe is full, so already woken
+
+    def __watcher(self, poll_interval, inotify):
+        '''
+        Returns an inotify watcher on the input_path where possible, else a
+        polling watcher, and clears an earlier stop.
+        '''
+        self.__stopping.clear()
+        if inotify and sys.platform.startswith('linux'):
+            if self.__wake is None:
+                self.__wake = os.pipe()
+                os.set_blocking(self.__wake[1], False)
+            try:
+                return _InotifyWatcher(self.__input_path, self.__wake[0])
+            except (OSError, AttributeError):
+                self.__root_logger.warning(
+                    'inotify unavailable, polling:\t{}'.format(
+                        self.__input_path))
+        return _PollingWatcher(poll_interval, self.__stopping)
+
+    def __arrived(self, names):
+        '''
+        Returns the paths of files to push, found by a scan of the input_path
+        if names is None, else the given names reported by inotify.
+        '''
+        if names is None:
+            return self.__scan_input()
+        # closed after writing or moved in, so complete
+        for name in names:
+            self.__pending.pop(name, None)
+        return [os.path.join(self.__input_path, name) for name in names]
+
+    def __wait_input(self, watcher, last_file, timeout):
+        '''
+        Waits for files to arrive in the input_path.
+
+        @return: names of files which arrived, None if the input_path has to
+            be scanned, or False once no file arrived for timeout seconds
+            since last_file (a time.monotonic()) or stop was called
+        '''
+        wait = None
+        if timeout is not None:
+            wait = last_file + timeout - time.monotonic()
+            if wait <= 0:
+                return False
+        if self.__pending:
+            # look again once files which were still being written may
+            # have been quiet for long enough
+            wait = min(self.__quiet_period, wait or math.inf)
+        # and every retry_interval for files which failed to push, which
+        # inotify does not report again
+        wait = min(self.__retry_interval, wait or math.inf)
+        names = watcher.wait(wait)
+        if self.__stopping.is_set():
+            return False
+        if names == []:
+            return None
+        return names
+
+    def metrics(self):
+        '''
+        Returns a snapshot of the metrics of this queue as a dict with
+            counters: number of push, pop (moves to the output_path) and
+                archive operations, their _errors and their _bytes
+            latency: histogram dicts (count, sum, max, p50, p99 and buckets
+                of upper bound -> count) of the seconds the push, pop and
+                archive operations took, and of the dwell time of files on
+                the queue
+            depth: number of files on the queue
+            oldest_age: seconds the longest queued file has been waiting
+        '''
+        snapshot = self.__metrics.snapshot()
+        snapshot['depth'] = len(self.__q)
+        queued = list(self.__enqueued.values())
+        snapshot['oldest_age'] = time.time() - min(queued) if queued else 0.0
+        return snapshot
+
+    def __export_metrics(self, force=False):
+        '''
+        Passes the metrics to the metrics_exporter if metrics_interval has
+        passed since it was last called, or if force is True.
+        '''
+        if self.__metrics_exporter is None:
+            return
+        now = time.monotonic()
+        if not force and now < self.__next_export:
+            return
+        self.__next_export = now + self.__metrics_interval
+        try:
+            self.__metrics_exporter(self.metrics())
+        except Exception:
+            self.__root_logger.error('Error exporting FileQueue metrics',
+                                     exc_info=True)
+
+    def close(self):
+        '''
+        Closes the journal and stops the workers and the renewal of the lease,
+        if there are any, after waiting for archived files to be compressed.
+        Not to be called while watch or stream are running.
+        '''
+        if self.__compressor is not None:
+            # waits for the files still to compress
+            self.__compressor.shutdown()
+        if self.__retention is not None:
+            self.__retention.close()
+            self.__retention = None
+        self.__export_metrics(force=True)
+        if self.__wake is not None:
+            for wake_fd in self.__wake:
+                os.close(wake_fd)
+            self.__wake = None
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+        if self.__lease is not None:
+            self.__lease.close()
+
+    def __recover(self):
+        '''
+        Rebuilds the queue by replaying the journal, adds files in the
+        queue_path which the journal missed (a crash between moving a file and
+        journaling it), then compacts the journal.
+        '''
+        queued = OrderedDict()  # queue file path -> None, in push order
+        try:
+            with open(self.__journal_path, encoding='utf-8') as journal:
+                for line in journal:
+                    if not line.endswith('\n'):
+                        break  # the last record was cut off by a crash
+                    path = json.loads(line[1:])
+                    if line[0] == '+':
+                        queued.pop(path, None)
+                        queued[path] = None
+                    else:
+                        queued.pop(path, None)
+        except FileNotFoundError:
+            pass
+
+        paths = [path for path in queued if os.path.isfile(path)]
+        known = set(paths)
+        with os.scandir(self.__queue_path) as entries:
+            missed = [entry for entry in entries
+                      if entry.is_file() and not entry.name.startswith('.')
+                      and entry.path not in known]
+        missed.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        paths.extend(entry.path for entry in missed)
+
+        self.__enqueue(*paths)
+        if paths:
+            self.__root_logger.info(
+                'Recovered {} files onto FileQueue'.format(len(paths)))
+        self.__journal_compact()
+
+    def __journal_append(self, operation, *paths):
+        '''
+        Appends a push ('+') or pop ('-') of paths to the journal, compacting
+        it once most of its records are for files which have left the queue.
+        '''
+        if self.__journal is None or not paths:
+            return
+        self.__journal.writelines(operation + json.dumps(path) + '\n'
+                                  for path in paths)
+        self.__journal.flush()
+        self.__journal_records += len(paths)
+        if self.__journal_records > 2 * len(self.__q) + 1024:
+            self.__journal_compact()
+
+    def __journal_compact(self):
+        '''
+        Replaces the journal with one push record per file on the queue.  The
+        new journal is written to a temporary file and renamed over the old
+        one, so a crash leaves one or the other intact.
+        '''
+        if self.__journal is not None:
+            self.__journal.close()
+        tmp_path = self.__journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as journal:
+            journal.writelines('+' + json.dumps(path) + '\n'
+                               for path in self.__q)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.__journal_path)
+        self.__journal = open(self.__journal_path, 'a', encoding='utf-8')
+        self.__journal_records = len(self.__q)
+
+    def __archive_file(self, in_file, log=True):
         '''
         Handles archiving the file.
+
+        @return: (path, strategy) where path is the archived file, and
+            strategy is 'move' if the popped file itself was moved there,
+            the archive_compression if it is being compressed there, else
+            the one returned by _clone_file
         '''
         src = in_file
-        dst = os.path.join(self.__archive_path,
-                           os.path.basename(in_file))
-        print('Archiving to:\t{}'.format(dst))
-        self.__root_logger.info('Archiving to:\t{}'.format(dst))
-        if src == dst:
-            return shutil.move(src, dst)
-        else:
-            shutil.copyfile(src, dst)  # don't want to return anything here
+        name = os.path.basename(in_file)
+        directory = self.__archive_dir(name)
+        dst = os.path.join(directory, name)
+        size = _file_size(src)
+        started = time.perf_counter()
+        try:
+            if _same_dir(os.path.dirname(src), self.__archive_path):
+                # popped into the archive_path itself
+                strategy = 'move'
+                dst = shutil.move(src, dst)
+            elif self.__compression is None:
+                # the popped file stays where it is
+                strategy = _clone_file(src, dst, link=self.__archive_link)
+            else:
+                # a cheap copy to compress, which the popped file can be
+                # moved away from meanwhile
+                staged = self.__temp_file(directory, name, '.staged')
+                _clone_file(src, staged, link=self.__archive_link)
+                dst += COMPRESSIONS[self.__compression]
+                self.__compressor.submit(self.__compress, staged, dst)
+                strategy = self.__compression
+        except Exception:
+            self.__metrics.fail('archive')
+            raise
+        self.__metrics.record('archive', time.perf_counter() - started, size)
+        if self.__compression is None or strategy == 'move':
+            self.__retain(dst)
+        if log:
+            print('Archiving to:\t{}'.format(dst))
+            self.__root_logger.info(
+                'Archived ({}) to:\t{}'.format(strategy, dst))
+        return dst, strategy
+
+    def __compress(self, staged, dst):
+        '''
+        Compresses the staged copy of a popped file into dst and removes it.
+        If that fails, the copy is kept uncompressed instead.
+        '''
+        part = None
+        try:
+            part = self.__temp_file(os.path.dirname(dst),
+                                    os.path.basename(dst), '.part')
+            with open(staged, 'rb') as fsrc, _open_compressed(
+                    part, 'wb', self.__compression,
+                    self.__compression_level) as fdst:
+                shutil.copyfileobj(fsrc, fdst, 1 << 20)
+            os.replace(part, dst)
+            os.remove(staged)
+        except Exception:
+            self.__metrics.fail('archive')
+            self.__root_logger.error(
+                'Error compressing archived file:\t{}'.format(dst),
+                exc_info=True)
+            dst = dst[:-len(COMPRESSIONS[self.__compression])]
+            try:
+                if part is not None and os.path.exists(part):
+                    os.remove(part)
+                os.replace(staged, dst)
+            except Exception:
+                # nobody waits for this thread, so only the log can tell
+                self.__root_logger.error(
+                    'Error keeping uncompressed archived file:\t{}'.format(
+                        dst), exc_info=True)
+                return
+        try:
+            self.__retain(dst)
+        except Exception:
+            self.__root_logger.error(
+                'Error applying archive retention to:\t{}'.format(dst),
+                exc_info=True)
+
+    @staticmethod
+    def __temp_file(directory, name, suffix):
+        '''
+        Creates an empty hidden file named after name in directory, unique
+        so that files of the same name archived at the same time do not
+        clash, and returns its path.
+        '''
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix='.' + name + '.',
+                                    dir=directory)
+        os.close(fd)
+        return path
+
+    def __retain(self, path):
+        '''
+        Adds an archived file to the retention index and removes the oldest
+        archived files over a limit, but not this one: when popped into the
+        archive_path it is the file pop returns.
+        '''
+        if self.__retention is None:
+            return
+        self.__retention.add(path, _file_size(path))
+        self.__log_pruned(self.__retention.prune(keep=path))
+
+    def prune_archive(self):
+        '''
+        Removes the archived files over the archive_max_age,
+        archive_max_bytes or archive_max_count limits, oldest first.  Only
+        needed to remove files which grew too old while nothing was archived,
+        archiving a file prunes too.
+
+        @return: the paths of the removed files
+        '''
+        if self.__retention is None:
+            return []
+        removed = self.__retention.prune()
+        self.__log_pruned(removed)
+        return removed
+
+    def __log_pruned(self, removed):
+        ''' Logs the archived files removed by the retention limits. '''
+        if removed:
+            self.__root_logger.info(
+                'Pruned {} archived files, oldest:\t{}'.format(
+                    len(removed), os.path.basename(removed[0])))
+
+    def __archive_dir(self, name):
+        '''
+        Returns the directory a file is archived in under the archive_layout,
+        creating it unless it is known to exist.
+        '''
+        if self.__archive_layout is None:
+            return self.__archive_path
+        path = os.path.join(self.__archive_path, self.__archive_layout(name))
+        if path not in self.__archive_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.__archive_dirs.add(path)
+        return path
 
     archive_path = property(get_archive_path, set_archive_path, None, None)
     queue_path = property(get_queue_path, set_queue_path, None, None)
@@ -3,10 +3,22 @@ Tests for the Decorator module.
 
 @author: chrcoe
 '''
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import timeit
 import unittest
+import warnings
+
+from standardlibs.Decorators import retry, memoize_expire, deprecated, \
+    CircuitBreaker, CircuitOpenError, DiskCache, LRUCache, RetryError, \
+    make_key
+
 
-from standardlibs.Decorators import retry, memoize_expire, deprecated
 class DecoratorsTest(unittest.TestCase):
 
     def setUp(self):
@@ -47,6 +59,199 @@ class DecoratorsTest(unittest.TestCase):
 
         self.assertTrue(passFunct(True))
 
+    def test_retry_backoff(self):
+        ''' Are waits capped at max_delay, jittered within bounds, and does
+        the final exception carry the last error? '''
+        waits = []
+
+        @retry(4, delay=1, backoff=3, max_delay=5, sleep=waits.append)
+        def always_false():
+            return False
+
+        with self.assertRaises(RetryError) as ctx:
+            always_false()
+        self.assertEqual(waits, [1, 3, 5, 5])
+        self.assertEqual(ctx.exception.attempts, 5)
+        self.assertIs(ctx.exception.last_result, False)
+        self.assertIsNone(ctx.exception.last_error)
+
+        waits = []
+
+        @retry(20, delay=1, max_delay=8, jitter='full', sleep=waits.append)
+        def full_jitter():
+            return False
+
+        with self.assertRaises(RetryError):
+            full_jitter()
+        self.assertEqual(len(waits), 20)
+        self.assertTrue(all(0 <= wait <= 8 for wait in waits))
+
+        waits = []
+
+        @retry(20, delay=1, max_delay=8, jitter='decorrelated',
+               sleep=waits.append)
+        def decorrelated_jitter():
+            return False
+
+        with self.assertRaises(RetryError):
+            decorrelated_jitter()
+        self.assertTrue(all(1 <= wait <= 8 for wait in waits))
+
+        with self.assertRaises(ValueError):
+            retry(1, jitter='some')
+
+    def test_retry_exceptions(self):
+        ''' Are listed exceptions retried, other exceptions raised at once,
+        and is the deadline respected? '''
+        calls = []
+        waits = []
+
+        @retry(3, delay=1, exceptions=(OSError,), sleep=waits.append)
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OSError('locked')
+            return 'done'
+
+        self.assertEqual(flaky(), 'done')
+        self.assertEqual(waits, [1, 2])
+
+        @retry(3, delay=1, exceptions=(OSError,), sleep=waits.append)
+        def broken():
+            raise OSError('gone')
+
+        with self.assertRaises(RetryError) as ctx:
+            broken()
+        self.assertIsInstance(ctx.exception.last_error, OSError)
+        self.assertIs(ctx.exception.__cause__, ctx.exception.last_error)
+
+        @retry(3, delay=1, exceptions=(OSError,), sleep=waits.append)
+        def wrong():
+            raise KeyError('not retried')
+
+        with self.assertRaises(KeyError):
+            wrong()
+
+        calls = []
+
+        @retry(10, delay=0.05, deadline=0.12)
+        def slow_false():
+            calls.append(1)
+            return False
+
+        with self.assertRaises(RetryError):
+            slow_false()
+        # the second wait of 0.1 seconds would end past the deadline
+        self.assertEqual(len(calls), 2)
+
+    def test_retry_async(self):
+        ''' Do retrying coroutines wait concurrently without blocking the
+        loop, and does cancelling one stop it mid wait? '''
+        calls = []
+
+        @retry(2, delay=0.05)
+        async def flaky(n):
+            calls.append(n)
+            return calls.count(n) > 2
+
+        async def run_many():
+            return await asyncio.gather(*(flaky(n) for n in range(100)))
+
+        t0 = time.time()
+        results = asyncio.run(run_many())
+        total_time = time.time() - t0
+        self.assertEqual(results, [True] * 100)
+        self.assertEqual(len(calls), 300)
+        # each coroutine waits 0.05 + 0.1 seconds, all at the same time
+        self.assertLess(total_time, 1)
+
+        attempts = []
+
+        @retry(5, delay=10)
+        async def never():
+            attempts.append(1)
+            return False
+
+        async def cancel_during_wait():
+            task = asyncio.ensure_future(never())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_during_wait())
+        self.assertEqual(attempts, [1])
+
+    def test_circuit_breaker(self):
+        ''' Does a circuit open after the threshold, fail fast while open,
+        and let a single probe through once the timeout has passed? '''
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05,
+                                 key=lambda host: host)
+        up = {'a': False, 'b': True}
+        calls = []
+
+        @breaker
+        def send(host):
+            calls.append(host)
+            return up[host]
+
+        self.assertFalse(send('a'))
+        self.assertFalse(send('a'))
+        self.assertEqual(breaker.state('a'), CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            send('a')
+        self.assertEqual(ctx.exception.target, 'a')
+        self.assertEqual(calls, ['a', 'a'])
+        # other targets are unaffected
+        self.assertTrue(send('b'))
+        self.assertEqual(breaker.state('b'), CircuitBreaker.CLOSED)
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.state('a'), CircuitBreaker.HALF_OPEN)
+        self.assertFalse(send('a'))  # the probe fails, open again
+        with self.assertRaises(CircuitOpenError):
+            send('a')
+
+        time.sleep(0.06)
+        up['a'] = True
+        self.assertTrue(send('a'))
+        self.assertEqual(breaker.state('a'), CircuitBreaker.CLOSED)
+
+    def test_retry_breaker(self):
+        ''' Once retries open the circuit, do later calls fail fast instead
+        of retrying? '''
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        calls = []
+        waits = []
+
+        @retry(5, delay=1, exceptions=(OSError,), sleep=waits.append,
+               breaker=breaker)
+        def send(name):
+            calls.append(name)
+            raise OSError('host down')
+
+        with self.assertRaises(CircuitOpenError):
+            send('first')
+        self.assertEqual(calls, ['first'] * 3)
+        with self.assertRaises(CircuitOpenError):
+            send('second')
+        self.assertEqual(calls, ['first'] * 3)
+        self.assertEqual(len(waits), 3)
+
+    def test_retry_breaker_success(self):
+        ''' Does the breaker judge attempts by the success of retry, so
+        falsy results which retry accepts do not open the circuit? '''
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+        @retry(3, delay=1, success=lambda result: result is not None,
+               sleep=lambda wait: None, breaker=breaker)
+        def count():
+            return 0
+
+        for _ in range(3):
+            self.assertEqual(count(), 0)
+        self.assertEqual(breaker.state(), CircuitBreaker.CLOSED)
+
     def test_memoize_expire(self):
 
         def norm_fib(n):
@@ -74,6 +279,331 @@ class DecoratorsTest(unittest.TestCase):
 
         self.assertLess(total_time, 0.02)
 
+    def test_memoize_expire_maxsize(self):
+        ''' Does the cache evict the least recently used result? '''
+        calls = []
+
+        @memoize_expire(maxsize=2)
+        def square(n):
+            calls.append(n)
+            return n * n
+
+        square(1)
+        square(2)
+        square(1)  # 1 is now the most recently used
+        square(3)  # evicts 2
+        self.assertEqual(len(square.cache), 2)
+        square(1)
+        self.assertEqual(calls, [1, 2, 3])
+        square(2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+    def test_memoize_expire_ttl(self):
+        ''' Are results recomputed after the ttl, and are expired entries
+        dropped from the cache rather than kept around? '''
+        calls = []
+
+        @memoize_expire(ttl=0.05)
+        def ident(n):
+            calls.append(n)
+            return n
+
+        ident(1)
+        ident(1)
+        self.assertEqual(calls, [1])
+        time.sleep(0.06)
+        ident(1)
+        self.assertEqual(calls, [1, 1])
+
+        for i in range(10):
+            ident(i + 100)
+        time.sleep(0.06)
+        ident(2)  # storing sweeps out everything that expired
+        self.assertEqual(len(ident.cache), 1)
+
+    def test_memoize_expire_keys(self):
+        ''' Are distinct arguments with equal reprs cached separately, and
+        do unhashable arguments and custom keys work? '''
+
+        class Same(object):
+            ''' Every instance has the same repr. '''
+            def __repr__(self):
+                return 'Same'
+
+        @memoize_expire
+        def ident(value):
+            return value
+
+        first, second = Same(), Same()
+        self.assertIs(ident(first), first)
+        self.assertIs(ident(second), second)
+
+        @memoize_expire
+        def total(values, scale=1):
+            return sum(values) * scale
+
+        self.assertEqual(total([1, 2]), 3)
+        self.assertEqual(total([1, 2], scale=2), 6)
+        self.assertEqual(total((1, 2)), 3)
+        self.assertEqual(len(total.cache), 3)
+
+        @memoize_expire(key=lambda values: len(values))
+        def first_item(values):
+            return values[0]
+
+        self.assertEqual(first_item([1, 2]), 1)
+        self.assertEqual(first_item([3, 4]), 1)  # same key on purpose
+
+        @memoize_expire(typed=True)
+        def kind(value):
+            return type(value)
+
+        self.assertIs(kind(1), int)
+        self.assertIs(kind(1.0), float)
+
+    def test_make_key_speed(self):
+        ''' Is make_key several times faster than the old repr based key
+        on small arguments? '''
+        args, kwargs = (1, 'abc'), {}
+
+        def old_key():
+            return str(args) + str(hash(frozenset(kwargs.items())))
+
+        def new_key():
+            return make_key(args, kwargs)
+
+        old_time = min(timeit.repeat(old_key, number=20000, repeat=5))
+        new_time = min(timeit.repeat(new_key, number=20000, repeat=5))
+        self.assertLess(new_time * 3, old_time)
+
+    def test_memoize_expire_single_flight(self):
+        ''' Do concurrent misses on one key share a single call while
+        different keys still run in parallel? '''
+        calls = []
+        barrier = threading.Barrier(2, timeout=5)
+
+        @memoize_expire(thread_safe=True)
+        def slow(n):
+            calls.append(n)
+            if n in ('a', 'b'):
+                barrier.wait()  # only passes if 'a' and 'b' overlap
+            time.sleep(0.05)
+            return n
+
+        threads = [threading.Thread(target=slow, args=(1,))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+
+        results = []
+        threads = [threading.Thread(target=lambda n=n: results.append(slow(n)))
+                   for n in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ['a', 'b'])
+
+    def test_memoize_expire_single_flight_error(self):
+        ''' Do waiting callers receive the exception of the shared call,
+        and is the failure left uncached? '''
+        calls = []
+        errors = []
+
+        @memoize_expire(thread_safe=True)
+        def fail(n):
+            calls.append(n)
+            time.sleep(0.05)
+            raise KeyError(n)
+
+        def call():
+            try:
+                fail(1)
+            except KeyError as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(errors), 4)
+        with self.assertRaises(KeyError):
+            fail(1)
+        self.assertEqual(len(calls), 2)
+
+    def test_memoize_expire_async(self):
+        ''' Are awaited results cached, and do concurrent awaiters share a
+        single call? '''
+        calls = []
+
+        @memoize_expire
+        async def fetch(n):
+            calls.append(n)
+            await asyncio.sleep(0.01)
+            return n * 2
+
+        async def run():
+            first = await asyncio.gather(*(fetch(1) for _ in range(5)))
+            second = await fetch(1)
+            third = await fetch(2)
+            return first, second, third
+
+        first, second, third = asyncio.run(run())
+        self.assertEqual(first, [2] * 5)
+        self.assertEqual(second, 2)
+        self.assertEqual(third, 4)
+        self.assertEqual(calls, [1, 2])
+
+    def test_disk_cache_survives_restart(self):
+        ''' Are results stored with cache_dir still there for a new
+        decorator on the same function, with the ttl still applied? '''
+        with tempfile.TemporaryDirectory() as cache_dir:
+            calls = []
+
+            def square(n):
+                calls.append(n)
+                return {'square': n * n}
+
+            first = memoize_expire(square, cache_dir=cache_dir, ttl=0.2)
+            self.assertEqual(first(3), {'square': 9})
+            self.assertEqual(first(3), {'square': 9})
+            self.assertEqual(calls, [3])
+            self.assertTrue(os.listdir(cache_dir))
+
+            # a "restarted" process builds a new wrapper on the same directory
+            second = memoize_expire(square, cache_dir=cache_dir, ttl=0.2)
+            self.assertEqual(second(3), {'square': 9})
+            self.assertEqual(calls, [3])
+
+            time.sleep(0.25)
+            self.assertEqual(second(3), {'square': 9})
+            self.assertEqual(calls, [3, 3])
+
+    def test_disk_cache_unhashable(self):
+        ''' Do list arguments work with cache_dir for thread safe and
+        coroutine functions, which also track calls in flight by key? '''
+        with tempfile.TemporaryDirectory() as cache_dir:
+            calls = []
+
+            @memoize_expire(cache_dir=cache_dir, thread_safe=True)
+            def total(values):
+                calls.append(values)
+                return sum(values)
+
+            @memoize_expire(cache_dir=cache_dir)
+            async def fetch(values):
+                calls.append(values)
+                return list(reversed(values))
+
+            async def run():
+                return await asyncio.gather(fetch([1, 2]), fetch([1, 2]))
+
+            self.assertEqual(total([1, 2]), 3)
+            self.assertEqual(total([1, 2]), 3)
+            self.assertEqual(asyncio.run(run()), [[2, 1], [2, 1]])
+            self.assertEqual(calls, [[1, 2], [1, 2]])
+            self.assertTrue(total.cache_invalidate([1, 2]))
+
+    def test_disk_cache_limits(self):
+        ''' Does a sweep evict the least recently used entries? '''
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(os.path.join(cache_dir, 'test.sqlite'),
+                              maxsize=2, sweep_every=100)
+            cache.set(('a', 1), 'a')
+            cache.set(('b', 2), 'b')
+            self.assertEqual(cache.get(('a', 1)), 'a')  # b is now oldest
+            cache.set(('c', 3), 'c')
+            self.assertEqual(len(cache), 3)  # limits apply on the next sweep
+            cache.sweep()
+            self.assertEqual(len(cache), 2)
+            self.assertNotIn(('b', 2), cache)
+            self.assertEqual(cache.pop(('c', 3)), 'c')
+            self.assertIsNone(cache.pop(('c', 3)))
+
+    def test_disk_cache_set_keys(self):
+        ''' Do keys holding sets and dicts hit in processes with another
+        hash seed, and regardless of the order dict items were added in? '''
+        key = (frozenset(('alpha', 'beta', 'gamma', 'delta')),
+               {'x': {'one', 'two', 'three'}, 'y': [1, 2]})
+        script = (
+            'import sys\n'
+            'from standardlibs.Decorators import DiskCache\n'
+            'cache = DiskCache(sys.argv[1])\n'
+            'key = ' + repr(key) + '\n'
+            'if sys.argv[2] == "set":\n'
+            '    cache.set(key, "cached")\n'
+            'else:\n'
+            '    print(cache.get(key))\n')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'test.sqlite')
+            for seed, action in ((1, 'set'), (2, 'get'), (3, 'get')):
+                env = dict(os.environ, PYTHONHASHSEED=str(seed))
+                output = subprocess.run(
+                    [sys.executable, '-c', script, path, action], cwd=root,
+                    env=env, check=True, stdout=subprocess.PIPE,
+                    universal_newlines=True).stdout
+                if action == 'get':
+                    self.assertEqual(output.strip(), 'cached')
+            reordered = (key[0], {'y': [1, 2], 'x': key[1]['x']})
+            self.assertEqual(DiskCache(path).get(reordered), 'cached')
+
+    def test_memoize_expire_cache_info(self):
+        ''' Do cache_info, cache_clear and cache_invalidate report and
+        manage the cache? '''
+
+        @memoize_expire(maxsize=2)
+        def slow_square(n):
+            time.sleep(0.01)
+            return n * n
+
+        slow_square(1)
+        slow_square(1)
+        slow_square(2)
+        slow_square(3)  # evicts 1
+        info = slow_square.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 3))
+        self.assertEqual((info.maxsize, info.currsize), (2, 2))
+        self.assertEqual(info.evictions, 1)
+        self.assertGreaterEqual(info.latency_saved, 0.01)
+
+        self.assertTrue(slow_square.cache_invalidate(3))
+        self.assertFalse(slow_square.cache_invalidate(3))
+        self.assertEqual(slow_square.cache_info().currsize, 1)
+
+        slow_square.cache_clear()
+        info = slow_square.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 0, 0))
+
+        @memoize_expire
+        def total(values):
+            return sum(values)
+
+        total([1, 2])
+        self.assertTrue(total.cache_invalidate([1, 2]))
+
+    def test_lru_cache_maxbytes(self):
+        ''' Does the byte budget evict entries and skip oversized values? '''
+        cache = LRUCache(maxbytes=10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('c', 'x' * 4)  # evicts a
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+        self.assertEqual(cache.currbytes, 8)
+        cache.set('d', 'x' * 11)  # larger than the whole budget
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.currbytes, 8)
+
+        with self.assertRaises(ValueError):
+            LRUCache(maxsize=0)
+
     def test_deprecated(self):
         ''' Tests that a deprecated function returns the DeprecationWarning. '''
 
@@ -83,5 +613,64 @@ class DecoratorsTest(unittest.TestCase):
 
         self.assertWarns(DeprecationWarning, dep_func)
 
+    def test_deprecated_once(self):
+        ''' Is the warning emitted once per call site, or once in total,
+        without changing the global warning filters? '''
+        filters = list(warnings.filters)
+
+        @deprecated
+        def per_site():
+            return True
+
+        @deprecated(once_per='process')
+        def per_process():
+            return True
+
+        self.assertEqual(per_site.__name__, 'per_site')
+        self.assertEqual(warnings.filters, filters)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for _ in range(3):
+                per_site()  # one call site
+            per_site()  # another call site
+            for _ in range(3):
+                per_process()
+            per_process()
+        self.assertEqual(len(caught), 3)
+        self.assertTrue(all(warning.filename == __file__
+                            for warning in caught))
+
+    def test_deprecated_speed(self):
+        ''' After the first warning, is a deprecated call much cheaper than
+        warning on every call, and close to a plain wrapper? '''
+
+        def func():
+            return True
+
+        def warn_always():
+            warnings.warn('Call to deprecated function func.',
+                          category=DeprecationWarning)
+            return func()
+
+        def passthrough(*args, **kwargs):
+            return func(*args, **kwargs)
+
+        per_site = deprecated(func)
+        per_process = deprecated(once_per='process')(func)
+
+        def timed(call):
+            return min(timeit.repeat(call, number=20000, repeat=5))
+
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            old_time = timed(warn_always)
+            site_time = timed(per_site)
+            process_time = timed(per_process)
+            plain_time = timed(passthrough)
+
+        self.assertLess(site_time * 2, old_time)
+        self.assertLess(process_time, plain_time * 2)
+
 if __name__ == "__main__":
     unittest.main()
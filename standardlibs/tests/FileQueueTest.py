@@ -3,11 +3,16 @@ Tests for the FileQueue module.
 
 @author: chrcoe
 '''
+import asyncio
 import os
 import shutil
+import sqlite3
+import threading
+import time
 import unittest
 
-from standardlibs.FileQueue import FileQueue
+from standardlibs.FileQueue import FileQueue, CLAIMS_DIR, JOURNAL_NAME, \
+    LEASE_NAME, hash_layout, open_archived, priority_order
 
 # pylint: disable=too-many-public-methods
 # A UNIT test will have as many methods as needed to complete testing.
@@ -187,6 +192,767 @@ class FileQueueTest(unittest.TestCase):
 
 #         shutil.rmtree(self.base_dir)
 
+    def test_watch(self):
+        ''' Are files already there and files arriving while watching pushed
+        and yielded promptly, with and without inotify? '''
+        for inotify in (True, False):
+            file_q = FileQueue(
+                self.input_path, self.output_path, self.queue_path,
+                self.archive_path)
+            early_file = os.path.join(self.input_path, 'early.txt')
+            with open(early_file, 'w') as file_:
+                file_.write('test text')
+
+            def write_late():
+                time.sleep(0.2)
+                with open(os.path.join(self.input_path, 'late.txt'),
+                          'w') as file_:
+                    file_.write('test text')
+
+            writer = threading.Thread(target=write_late)
+            writer.start()
+            found = []
+            for queue_file in file_q.watch(timeout=0.5, poll_interval=0.05,
+                                           inotify=inotify):
+                found.append((os.path.basename(queue_file), time.time()))
+                self.assertTrue(os.path.isfile(queue_file))
+            writer.join()
+
+            self.assertEqual([name for name, _ in found],
+                             ['early.txt', 'late.txt'])
+            # the late file shows up well before the 0.5 second timeout
+            self.assertLess(found[1][1] - found[0][1], 0.45)
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def test_check_dir_incremental(self):
+        ''' Does check_dir leave the working directory alone, skip files a
+        previous pass failed to push until the retry_interval has passed,
+        and pick them up again straight away once changed? '''
+
+        class FlakyQueue(FileQueue):
+            ''' A FileQueue whose pushes fail until failures runs out. '''
+            pushed = []
+            failures = 2
+
+            def _FileQueue__push_file(self, in_file):
+                self.pushed.append(os.path.basename(in_file))
+                if self.failures:
+                    self.failures -= 1
+                    return False
+                return super()._FileQueue__push_file(in_file)
+
+        file_q = FlakyQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, retry_interval=0.2)
+        os.makedirs(os.path.join(self.input_path, 'subdir'))
+        test_file = os.path.join(self.input_path, 'test_file.txt')
+        with open(test_file, 'w') as file_:
+            file_.write('test text')
+
+        cwd = os.getcwd()
+        self.assertFalse(file_q.check_dir())
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(file_q.pushed, ['test_file.txt'])
+
+        file_q.check_dir()  # unchanged, so not pushed again yet
+        self.assertEqual(file_q.pushed, ['test_file.txt'])
+
+        with open(test_file, 'a') as file_:
+            file_.write(' and more')
+        self.assertFalse(file_q.check_dir())
+        self.assertEqual(file_q.pushed, ['test_file.txt'] * 2)
+
+        time.sleep(0.25)  # tried again once the retry_interval passed
+        self.assertTrue(file_q.check_dir())
+        self.assertEqual(file_q.pushed, ['test_file.txt'] * 3)
+        self.assertFalse(os.path.isfile(test_file))
+
+    def test_watch_retry(self):
+        ''' Does watch try again to push a file which failed to push, also
+        when inotify reported it? '''
+
+        class FlakyQueue(FileQueue):
+            ''' A FileQueue whose first push fails. '''
+            failures = 1
+
+            def _FileQueue__push_file(self, in_file):
+                if self.failures:
+                    self.failures -= 1
+                    return False
+                return super()._FileQueue__push_file(in_file)
+
+        for inotify in (True, False):
+            file_q = FlakyQueue(
+                self.input_path, self.output_path, self.queue_path,
+                self.archive_path, retry_interval=0.2)
+            test_file = os.path.join(self.input_path, 'test_file.txt')
+
+            def write(test_file=test_file):
+                with open(test_file, 'w') as file_:
+                    file_.write('test text')
+            # arrives while watching
+            writer = threading.Timer(0.1, write)
+            writer.start()
+            found = list(file_q.watch(timeout=0.6, inotify=inotify,
+                                      poll_interval=0.05))
+            writer.join()
+            self.assertEqual([os.path.basename(path) for path in found],
+                             ['test_file.txt'])
+            file_q.pop()
+            file_q.close()
+
+    def test_journal_recovery(self):
+        ''' Does a new FileQueue recover the order of a journaled queue,
+        including files the journal missed, and compact the journal? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, journal=True)
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            file_q.push(test_file)
+        self.assertEqual(
+            os.path.basename(file_q.pop(addtimestamp=False)), 'a.txt')
+        # dropped straight into the queue, e.g. moved just before a crash
+        with open(os.path.join(self.queue_path, 'd.txt'), 'w') as file_:
+            file_.write('test text')
+
+        # "restart" without closing the first FileQueue
+        recovered = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, journal=True)
+        popped = []
+        out_file = recovered.pop(addtimestamp=False)
+        while out_file:
+            popped.append(os.path.basename(out_file))
+            out_file = recovered.pop(addtimestamp=False)
+        self.assertEqual(popped, ['b.txt', 'c.txt', 'd.txt'])
+
+        with open(os.path.join(self.queue_path, JOURNAL_NAME)) as journal:
+            self.assertEqual(len(journal.readlines()), 3 + 3)
+        recovered.close()
+        file_q.close()
+
+    def test_multiple_workers(self):
+        ''' Do workers sharing a queue_path pop every file exactly once, and
+        are claims of a dead worker put back after its lease expires? '''
+        workers = [FileQueue(self.input_path, self.output_path,
+                             self.queue_path, self.archive_path,
+                             worker_id=worker_id, lease_timeout=60)
+                   for worker_id in ('one', 'two')]
+        names = ['file_{}.txt'.format(i) for i in range(10)]
+        for name in names:
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            workers[0].push(test_file)
+
+        popped = []
+        out_files = [True, True]
+        while any(out_files):
+            # the second worker only knows these files from the queue_path
+            out_files = [worker.pop(addtimestamp=False) for worker in workers]
+            popped.extend(os.path.basename(out_file)
+                          for out_file in out_files if out_file)
+        self.assertEqual(sorted(popped), names)
+        self.assertEqual(len(popped), len(set(popped)))
+
+        # a worker died after claiming a file
+        dead_claims = os.path.join(self.queue_path, CLAIMS_DIR, 'dead')
+        os.makedirs(dead_claims)
+        with open(os.path.join(dead_claims, 'orphan.txt'), 'w') as file_:
+            file_.write('test text')
+        with open(os.path.join(dead_claims, LEASE_NAME), 'w'):
+            pass
+        self.assertIsNone(workers[1].pop())  # lease still fresh
+        old = time.time() - 120
+        os.utime(os.path.join(dead_claims, LEASE_NAME), (old, old))
+        out_file = workers[1].pop(addtimestamp=False)
+        self.assertEqual(os.path.basename(out_file), 'orphan.txt')
+
+        with self.assertRaises(ValueError):
+            FileQueue(self.input_path, self.output_path, self.queue_path,
+                      self.archive_path, journal=True, worker_id='three')
+
+    def test_push_pop_many(self):
+        ''' Do batches report an outcome per file without a failure stopping
+        the rest of the batch? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path)
+        test_files = []
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            test_files.append(test_file)
+        missing = os.path.join(self.input_path, 'missing.txt')
+
+        results = file_q.push_many(
+            [test_files[0], missing, test_files[1], test_files[2]])
+        self.assertEqual([result.src for result in results],
+                         [test_files[0], missing, test_files[1],
+                          test_files[2]])
+        self.assertIsInstance(results[1].error, FileNotFoundError)
+        self.assertIsNone(results[1].dst)
+        for result in (results[0], results[2], results[3]):
+            self.assertIsNone(result.error)
+            self.assertTrue(os.path.isfile(result.dst))
+            self.assertEqual(os.path.dirname(result.dst), self.queue_path)
+
+        results = file_q.pop_many(2)
+        self.assertEqual(len(results), 2)
+        stamps = set()
+        for result, name in zip(results, ('a', 'b')):
+            self.assertIsNone(result.error)
+            self.assertTrue(os.path.isfile(result.dst))
+            self.assertTrue(os.path.basename(result.dst).startswith(name))
+            stamps.add(os.path.basename(result.dst)[2:])
+        self.assertEqual(len(stamps), 1)  # one timestamp for the batch
+
+        results = file_q.pop_many(5, addtimestamp=False)
+        self.assertEqual([os.path.basename(result.dst) for result in results],
+                         ['c.txt'])
+        self.assertEqual(file_q.pop_many(5), [])
+
+    def test_batch_errors(self):
+        ''' Are errors other than OSError reported per file too, with
+        files which failed to pop put back on the queue? '''
+
+        class LockedQueue(FileQueue):
+            ''' Fails to move b.txt with a database error. '''
+            def _FileQueue__queue_file(self, src):
+                if os.path.basename(src) == 'b.txt':
+                    raise sqlite3.OperationalError('database is locked')
+                return super()._FileQueue__queue_file(src)
+
+            def _FileQueue__output_file(self, src, timestamp):
+                if os.path.basename(src) == 'a.txt':
+                    raise sqlite3.OperationalError('database is locked')
+                return super()._FileQueue__output_file(src, timestamp)
+
+        file_q = LockedQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path)
+        test_files = []
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            test_files.append(test_file)
+
+        results = file_q.push_many(test_files)
+        self.assertIsInstance(results[1].error, sqlite3.OperationalError)
+        self.assertTrue(os.path.isfile(test_files[1]))
+        self.assertIsNone(results[2].error)
+
+        results = file_q.pop_many(2, addtimestamp=False)
+        self.assertIsInstance(results[0].error, sqlite3.OperationalError)
+        self.assertIsNone(results[0].dst)
+        self.assertEqual(os.path.basename(results[1].dst), 'c.txt')
+        self.assertEqual(os.listdir(self.queue_path), ['a.txt'])
+        self.assertEqual(file_q.metrics()['depth'], 1)
+
+    def test_lease_renewal(self):
+        ''' Is the lease of a worker renewed while it is not popping, so a
+        long transfer keeps its claims, and does it expire after close? '''
+        worker = FileQueue(self.input_path, self.output_path,
+                           self.queue_path, self.archive_path,
+                           worker_id='one', lease_timeout=0.3)
+        lease = os.path.join(self.queue_path, CLAIMS_DIR, 'one', LEASE_NAME)
+        claimed = os.path.join(self.queue_path, CLAIMS_DIR, 'one', 'a.txt')
+        with open(claimed, 'w') as file_:
+            file_.write('test text')  # as if in the middle of moving it
+        other = FileQueue(self.input_path, self.output_path,
+                          self.queue_path, self.archive_path,
+                          worker_id='two', lease_timeout=0.3)
+        time.sleep(0.6)
+        self.assertIsNone(other.pop())
+        self.assertTrue(os.path.isfile(claimed))
+
+        worker.close()
+        time.sleep(0.4)
+        self.assertTrue(time.time() - os.stat(lease).st_mtime > 0.3)
+        out_file = other.pop(addtimestamp=False)
+        self.assertEqual(os.path.basename(out_file), 'a.txt')
+        other.close()
+
+    def test_archive_strategies(self):
+        ''' Are popped files hardlinked into the archive when possible, and
+        copied by another strategy when links are turned off? '''
+        for archive_link in (True, False):
+            file_q = FileQueue(
+                self.input_path, self.output_path, self.queue_path,
+                self.archive_path, archive_link=archive_link)
+            test_file = os.path.join(self.input_path, 'test_file.txt')
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            file_q.push(test_file)
+
+            result, = file_q.pop_many(1, addtimestamp=False)
+            archive_file = os.path.join(self.archive_path, 'test_file.txt')
+            with open(archive_file) as file_:
+                self.assertEqual(file_.read(), 'test text')
+            same_inode = os.path.samefile(result.dst, archive_file)
+            if archive_link:
+                self.assertEqual(result.archived_by, 'link')
+                self.assertTrue(same_inode)
+            else:
+                self.assertIn(result.archived_by,
+                              ('reflink', 'copy_file_range', 'copy'))
+                self.assertFalse(same_inode)
+
+    def test_workers(self):
+        ''' Do batches on the worker pool keep their order while never
+        having more bytes in flight than allowed? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, workers=3, max_inflight_bytes=20)
+        names = ['{}.txt'.format(index) for index in range(8)]
+        test_files = []
+        for name in names:
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('ten bytes!')
+            test_files.append(test_file)
+
+        results = file_q.push_many(test_files)
+        self.assertEqual([result.src for result in results], test_files)
+        self.assertTrue(all(result.error is None for result in results))
+
+        results = file_q.pop_many(8, addtimestamp=False)
+        self.assertEqual(
+            [os.path.basename(result.dst) for result in results], names)
+        for result in results:
+            self.assertIsNone(result.error)
+            with open(result.dst) as file_:
+                self.assertEqual(file_.read(), 'ten bytes!')
+        file_q.close()
+
+    def test_order(self):
+        ''' Are files popped smallest first, or by priority pattern, and
+        first in first out among equals? '''
+        sizes = {'big.txt': 1000, 'small.txt': 1, 'medium.txt': 10,
+                 'also_small.txt': 1}
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, order='smallest')
+        for name in ('big.txt', 'small.txt', 'medium.txt', 'also_small.txt'):
+            with open(os.path.join(self.input_path, name), 'w') as file_:
+                file_.write('x' * sizes[name])
+        file_q.push_many(
+            os.path.join(self.input_path, name)
+            for name in ('big.txt', 'small.txt', 'medium.txt',
+                         'also_small.txt'))
+        popped = [os.path.basename(file_q.pop(addtimestamp=False))
+                  for _ in range(4)]
+        self.assertEqual(popped, ['small.txt', 'also_small.txt',
+                                  'medium.txt', 'big.txt'])
+
+        for name in ('b.log', 'a.urgent', 'c.txt', 'd.urgent', 'e.log'):
+            with open(os.path.join(self.input_path, name), 'w') as file_:
+                file_.write('test text')
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, order=priority_order('*.urgent', '*.log'))
+        for name in ('b.log', 'a.urgent', 'c.txt', 'd.urgent', 'e.log'):
+            file_q.push(os.path.join(self.input_path, name))
+        popped = [os.path.basename(file_q.pop(addtimestamp=False))
+                  for _ in range(5)]
+        self.assertEqual(popped, ['a.urgent', 'd.urgent', 'b.log', 'e.log',
+                                  'c.txt'])
+
+        with self.assertRaises(ValueError):
+            FileQueue(self.input_path, self.output_path, self.queue_path,
+                      self.archive_path, order='largest')
+
+    def test_quiet_period(self):
+        ''' Does check_dir leave files alone until they stop changing? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, quiet_period=0.3)
+        test_file = os.path.join(self.input_path, 'upload.txt')
+        with open(test_file, 'w') as file_:
+            file_.write('partial')
+        self.assertFalse(file_q.check_dir())  # just written
+        self.assertTrue(os.path.isfile(test_file))
+
+        # not written to for longer than the quiet period
+        old = time.time() - 1
+        os.utime(test_file, (old, old))
+        self.assertTrue(file_q.check_dir())
+        self.assertFalse(os.path.isfile(test_file))
+
+        # a modification time from a clock ahead of ours: only pushed once
+        # found unchanged for the quiet period
+        other_file = os.path.join(self.input_path, 'skewed.txt')
+        with open(other_file, 'w') as file_:
+            file_.write('test text')
+        ahead = time.time() + 60
+        os.utime(other_file, (ahead, ahead))
+        self.assertFalse(file_q.check_dir())
+        with open(other_file, 'a') as file_:
+            file_.write(' and more')
+        os.utime(other_file, (ahead + 1, ahead + 1))
+        time.sleep(0.35)
+        self.assertFalse(file_q.check_dir())  # it changed meanwhile
+        time.sleep(0.35)
+        self.assertTrue(file_q.check_dir())
+        self.assertEqual(
+            [os.path.basename(file_q.pop(addtimestamp=False))
+             for _ in range(2)], ['upload.txt', 'skewed.txt'])
+
+    def test_stream(self):
+        ''' Does stream pop queued files, wait for new ones and end on
+        timeout or stop, with and without inotify? '''
+        for inotify in (True, False):
+            file_q = FileQueue(
+                self.input_path, self.output_path, self.queue_path,
+                self.archive_path)
+            queued_file = os.path.join(self.input_path, 'queued.txt')
+            with open(queued_file, 'w') as file_:
+                file_.write('test text')
+            file_q.push(queued_file)
+
+            def write_late():
+                time.sleep(0.2)
+                with open(os.path.join(self.input_path, 'late.txt'),
+                          'w') as file_:
+                    file_.write('test text')
+
+            writer = threading.Thread(target=write_late)
+            writer.start()
+            start = time.monotonic()
+            popped = [os.path.basename(path) for path in file_q.stream(
+                timeout=0.5, addtimestamp=False, poll_interval=0.05,
+                inotify=inotify)]
+            writer.join()
+            self.assertEqual(popped, ['queued.txt', 'late.txt'])
+            self.assertGreater(time.monotonic() - start, 0.5)
+
+            # stop wakes a stream waiting without a timeout
+            stopper = threading.Timer(0.2, file_q.stop)
+            stopper.start()
+            start = time.monotonic()
+            self.assertEqual(list(file_q.stream(inotify=inotify)), [])
+            self.assertLess(time.monotonic() - start, 2)
+            file_q.close()
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def test_astream(self):
+        ''' Does astream deliver files without blocking the event loop and
+        stop when the task is cancelled? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path)
+
+        async def consume(popped):
+            async for path in file_q.astream(addtimestamp=False):
+                popped.append(os.path.basename(path))
+
+        async def main():
+            popped = []
+            task = asyncio.ensure_future(consume(popped))
+            await asyncio.sleep(0.1)
+            with open(os.path.join(self.input_path, 'a.txt'), 'w') as file_:
+                file_.write('test text')
+            for _ in range(100):
+                if popped:
+                    break
+                await asyncio.sleep(0.05)  # the loop is not blocked
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return popped
+
+        self.assertEqual(asyncio.run(main()), ['a.txt'])
+        file_q.close()
+
+    def test_metrics(self):
+        ''' Are operations, bytes, depth and dwell time counted, and the
+        metrics passed to the exporter? '''
+        exported = []
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, metrics_exporter=exported.append,
+            metrics_interval=3600)
+        test_files = []
+        for name in ('a.txt', 'b.txt'):
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            test_files.append(test_file)
+        file_q.push(test_files[0])
+        file_q.push_many([test_files[1],
+                          os.path.join(self.input_path, 'missing.txt')])
+        time.sleep(0.05)
+
+        metrics = file_q.metrics()
+        self.assertEqual(metrics['depth'], 2)
+        self.assertGreaterEqual(metrics['oldest_age'], 0.05)
+        self.assertEqual(metrics['counters']['push'], 2)
+        self.assertEqual(metrics['counters']['push_errors'], 1)
+        self.assertEqual(metrics['counters']['push_bytes'], 18)
+
+        file_q.pop()
+        metrics = file_q.metrics()
+        self.assertEqual(metrics['depth'], 1)
+        self.assertEqual(metrics['counters']['pop'], 1)
+        self.assertEqual(metrics['counters']['archive_bytes'], 9)
+        dwell = metrics['latency']['dwell']
+        self.assertEqual(dwell['count'], 1)
+        self.assertGreaterEqual(dwell['max'], 0.05)
+        self.assertEqual(sum(dwell['buckets'].values()), 1)
+        self.assertLessEqual(dwell['p50'], dwell['max'])
+        self.assertEqual(metrics['latency']['push']['count'], 2)
+
+        self.assertEqual(exported, [])  # the interval has not passed yet
+        file_q.close()
+        self.assertEqual(len(exported), 1)
+        self.assertEqual(exported[0]['counters']['pop'], 1)
+
+    def test_dedup(self):
+        ''' Are files with the content of an earlier file skipped, also by
+        a new queue, while different and empty files are pushed? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, dedup=True)
+
+        def write(name, text):
+            path = os.path.join(self.input_path, name)
+            with open(path, 'w') as file_:
+                file_.write(text)
+            return path
+
+        self.assertTrue(file_q.push(write('a.txt', 'same text')))
+        self.assertIsNotNone(file_q.pop(addtimestamp=False))
+
+        results = file_q.push_many([
+            write('b.txt', 'same text'),  # duplicate of the archived a.txt
+            write('c.txt', 'same texT'),  # same size and start
+            write('d.txt', ''),
+            write('e.txt', '')])
+        self.assertEqual([result.dst is None for result in results],
+                         [True, False, False, False])
+        self.assertIsNone(results[0].error)
+        self.assertFalse(os.path.exists(results[0].src))
+
+        # the index outlives the queue
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, dedup=True)
+        duplicate = write('f.txt', 'same texT')
+        self.assertTrue(file_q.push(duplicate))
+        self.assertFalse(os.path.exists(duplicate))
+        self.assertIsNone(file_q.pop())
+        unique = write('g.txt', 'other text')
+        self.assertTrue(file_q.push(unique))
+        self.assertEqual(os.path.basename(file_q.pop(addtimestamp=False)),
+                         'g.txt')
+
+    def test_archive_layout(self):
+        ''' Are popped files archived in date or hash directories, also
+        when the output_path is the archive_path? '''
+        for layout in ('date', 'hash'):
+            for output_path in (self.output_path, None):
+                file_q = FileQueue(
+                    self.input_path, output_path, self.queue_path,
+                    self.archive_path, archive_layout=layout)
+                test_file = os.path.join(self.input_path, 'test_file.txt')
+                with open(test_file, 'w') as file_:
+                    file_.write('test text')
+                file_q.push(test_file)
+                result, = file_q.pop_many(1, addtimestamp=False)
+
+                if layout == 'date':
+                    shard = time.strftime('%Y/%m/%d')
+                else:
+                    shard = hash_layout('test_file.txt')
+                archived = os.path.join(self.archive_path, shard,
+                                        'test_file.txt')
+                self.assertTrue(os.path.isfile(archived))
+                self.assertFalse(os.path.exists(os.path.join(
+                    self.archive_path, 'test_file.txt')))
+                if output_path is None:
+                    self.assertEqual(result.dst, archived)
+                shutil.rmtree(self.base_dir, ignore_errors=True)
+
+        self.assertEqual(len(hash_layout('x').split(os.sep)), 2)
+        with self.assertRaises(ValueError):
+            FileQueue(self.input_path, self.output_path, self.queue_path,
+                      self.archive_path, archive_layout='weekly')
+
+    def test_archive_compression(self):
+        ''' Are archived files compressed in the background, readable with
+        open_archived and still recognized as duplicates? '''
+        for compression, extension in (('gzip', '.gz'), ('xz', '.xz')):
+            file_q = FileQueue(
+                self.input_path, self.output_path, self.queue_path,
+                self.archive_path, archive_compression=compression,
+                compression_level=1, dedup=True)
+            test_file = os.path.join(self.input_path, 'test_file.txt')
+            with open(test_file, 'w') as file_:
+                file_.write('test text' * 100)
+            file_q.push(test_file)
+            result, = file_q.pop_many(1, addtimestamp=False)
+            self.assertEqual(result.archived_by, compression)
+            self.assertEqual(os.path.dirname(result.dst), self.output_path)
+            file_q.close()  # waits for the compression
+
+            self.assertEqual(os.listdir(self.archive_path),
+                             ['test_file.txt' + extension])
+            archived = os.path.join(self.archive_path,
+                                    'test_file.txt' + extension)
+            self.assertLess(os.path.getsize(archived), 900)
+            with open_archived(archived) as file_:
+                self.assertEqual(file_.read(), b'test text' * 100)
+
+            duplicate = os.path.join(self.input_path, 'again.txt')
+            with open(duplicate, 'w') as file_:
+                file_.write('test text' * 100)
+            self.assertTrue(file_q.push(duplicate))
+            self.assertFalse(os.path.exists(duplicate))
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+
+        with self.assertRaises(ValueError):
+            FileQueue(self.input_path, self.output_path, self.queue_path,
+                      self.archive_path, archive_compression='rar')
+
+    def test_archive_retention(self):
+        ''' Are the oldest archived files removed once over the count,
+        size or age limits, also with compression? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, archive_max_count=3, archive_max_bytes=45)
+
+        def archive(name, text='test text'):
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write(text)
+            file_q.push(test_file)
+            file_q.pop(addtimestamp=False)
+
+        def archived():
+            return sorted(name for name in os.listdir(self.archive_path)
+                          if not name.startswith('.'))
+
+        for name in ('a.txt', 'b.txt', 'c.txt', 'd.txt'):
+            archive(name)
+        self.assertEqual(archived(), ['b.txt', 'c.txt', 'd.txt'])
+        archive('e.txt', 'x' * 30)  # 57 bytes with b.txt, 48 with c.txt
+        self.assertEqual(archived(), ['d.txt', 'e.txt'])
+        archive('e.txt', 'short')  # archived again, not counted twice
+        archive('f.txt')
+        self.assertEqual(archived(), ['d.txt', 'e.txt', 'f.txt'])
+        self.assertEqual(file_q.prune_archive(), [])
+        file_q.close()
+
+        # the index outlives the queue
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, archive_max_count=10,
+            archive_compression='gzip')
+        archive('g.txt')
+        file_q.close()
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, archive_max_age=0.2)
+        self.assertEqual(archived(), ['d.txt', 'e.txt', 'f.txt', 'g.txt.gz'])
+        time.sleep(0.25)
+        removed = file_q.prune_archive()
+        self.assertEqual(sorted(os.path.basename(path) for path in removed),
+                         ['d.txt', 'e.txt', 'f.txt', 'g.txt.gz'])
+        self.assertEqual(archived(), [])
+        file_q.close()
+
+    def test_archive_retention_popped(self):
+        ''' Is the file just popped into the archive_path kept, even when
+        it alone is over a limit? '''
+        file_q = FileQueue(
+            self.input_path, self.archive_path, self.queue_path,
+            self.archive_path, archive_max_bytes=5)
+        for name in ('a.txt', 'b.txt'):
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            file_q.push(test_file)
+            popped = file_q.pop(addtimestamp=False)
+            self.assertTrue(os.path.isfile(popped))
+        self.assertEqual(os.listdir(self.archive_path).count('a.txt'), 0)
+        file_q.close()
+
+    def test_archive_compression_same_name(self):
+        ''' Does a file archived under the name of one still waiting to be
+        compressed replace it, without either staged copy getting lost? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, archive_compression='xz')
+        for content in (os.urandom(8 * 1024 * 1024), b'second'):
+            test_file = os.path.join(self.input_path, 'a.bin')
+            with open(test_file, 'wb') as file_:
+                file_.write(content)
+            file_q.push(test_file)
+            file_q.pop(addtimestamp=False)
+        file_q.close()
+
+        self.assertEqual(os.listdir(self.archive_path), ['a.bin.xz'])
+        with open_archived(os.path.join(self.archive_path,
+                                        'a.bin.xz')) as file_:
+            self.assertEqual(file_.read(), b'second')
+
+    def test_archive_compression_workers(self):
+        ''' Does close wait for every file compressed after a batch popped
+        on the worker pool? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, workers=8, archive_compression='gzip')
+        names = ['{}.txt'.format(index) for index in range(16)]
+        for name in names:
+            with open(os.path.join(self.input_path, name), 'w') as file_:
+                file_.write('test text' * 1000)
+        file_q.push_many(os.path.join(self.input_path, name)
+                         for name in names)
+        file_q.pop_many(16, addtimestamp=False)
+        file_q.close()
+        self.assertEqual(sorted(os.listdir(self.archive_path)),
+                         sorted(name + '.gz' for name in names))
+
+    def test_dedup_workers(self):
+        ''' Are identical files pushed in one batch on the worker pool
+        pushed only once? '''
+        for trial in range(5):
+            file_q = FileQueue(
+                self.input_path, self.output_path, self.queue_path,
+                self.archive_path, dedup=True, workers=8)
+            test_files = []
+            for index in range(16):
+                test_file = os.path.join(self.input_path,
+                                         '{}.txt'.format(index))
+                with open(test_file, 'w') as file_:
+                    file_.write('redelivered')
+                test_files.append(test_file)
+            results = file_q.push_many(test_files)
+            self.assertEqual(
+                len([result for result in results if result.dst]), 1)
+            file_q.close()
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def test_watch_dedup(self):
+        ''' Does watch only yield files which were pushed, not duplicates
+        which were removed? '''
+        file_q = FileQueue(
+            self.input_path, self.output_path, self.queue_path,
+            self.archive_path, dedup=True)
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            with open(os.path.join(self.input_path, name), 'w') as file_:
+                file_.write('same text' if name != 'c.txt' else 'other')
+        found = list(file_q.watch(timeout=0.1, inotify=False))
+        self.assertEqual(len(found), 2)
+        for queue_file in found:
+            self.assertTrue(os.path.isfile(queue_file))
+        self.assertEqual(os.listdir(self.input_path), [])
+
     def test_negative_paths(self):
         ''' Negative test INPUT, QUEUE and ARCHIVE paths individually. '''
         # check INPUT
@@ -245,6 +1011,28 @@ class FileQueueTest(unittest.TestCase):
         output = file_q.pop(addtimestamp=False)
         self.assertEqual(os.path.join(self.archive_path, base_name), output)
 
+    def test_output_archive_alias(self):
+        ''' Is a file popped into the archive_path kept when the output
+        and archive paths are written differently? '''
+        link = os.path.join(self.base_dir, 'archive_link')
+        os.makedirs(self.archive_path)
+        os.symlink(self.archive_path, link)
+        aliases = (self.archive_path + os.sep,
+                   os.path.relpath(self.archive_path), link)
+        for index, output_path in enumerate(aliases):
+            file_q = FileQueue(self.input_path, output_path, self.queue_path,
+                               self.archive_path)
+            name = 'test_file{}.txt'.format(index)
+            test_file = os.path.join(self.input_path, name)
+            with open(test_file, 'w') as file_:
+                file_.write('test text')
+            file_q.push(test_file)
+            output = file_q.pop(addtimestamp=False)
+            self.assertTrue(os.path.isfile(output))
+            with open(os.path.join(self.archive_path, name)) as file_:
+                self.assertEqual(file_.read(), 'test text')
+            file_q.close()
+
     def test_properties(self):
         ''' Test all properties '''
         file_q = FileQueue(